@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from dotenv import load_dotenv
+from openaiClient import get_openai_client, OpenAIAPIError, RETRY_STATUS_CODES, MAX_BACKOFF_SECONDS
+from tokenCount import estimate_payloads, format_estimate
+
+load_dotenv()  # Settings below can be overridden in .env
+
+# OpenAI Batch API helpers: build a JSONL file of requests, submit it, wait and read the results
+BATCH_POLL_INTERVAL = float(os.getenv('BATCH_POLL_INTERVAL', 60))  # seconds between status checks
+BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', 50000))  # API limit of requests in one batch file
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', 190_000_000))  # API limit is 200 MB per batch file, kept under it
+BATCH_COMPLETION_WINDOW = "24h"
+
+# Batch statuses after which nothing changes anymore
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+logger = logging.getLogger(__name__)
+
+
+# Function to build one line of a batch input file
+def build_batch_request(custom_id, body, url="/v1/chat/completions"):
+    return {
+        "custom_id": str(custom_id),
+        "method": "POST",
+        "url": url,
+        "body": body
+    }
+
+
+# Function to write batch requests into a JSONL file
+def write_batch_file(file_path, batch_requests):
+    with open(file_path, "w", encoding="utf-8") as file:
+        for batch_request in batch_requests:
+            file.write(json.dumps(batch_request, ensure_ascii=False) + "\n")
+    logger.info(f"Wrote {len(batch_requests)} batch requests to {file_path}")
+
+
+# Function to upload a batch input file, returns the file id
+def upload_batch_file(file_path):
+    # Read once, a retried upload would send an already consumed file handle
+    with open(file_path, "rb") as file:
+        content = file.read()
+    response = get_openai_client().request(
+        "POST", "files",
+        files={"file": (os.path.basename(file_path), content, "application/jsonl")},
+        data={"purpose": "batch"}
+    )
+    file_id = response.json()["id"]
+    logger.info(f"Uploaded {file_path} as {file_id}")
+    return file_id
+
+
+# Function to find an already created batch of an input file, None if there is none
+def find_batch_for_file(input_file_id, limit=100):
+    response = get_openai_client().request("GET", "batches", params={"limit": limit})
+    for batch in response.json().get("data", []):
+        if batch.get("input_file_id") == input_file_id:
+            return batch
+    return None
+
+
+# Function to create a batch from an uploaded file.
+# Creating is not idempotent: a request that failed on the way back may still have created the
+# batch, so before every new attempt the existing batches are checked for this input file.
+def create_batch(input_file_id, endpoint="/v1/chat/completions", metadata=None):
+    client = get_openai_client()
+    payload = {
+        "input_file_id": input_file_id,
+        "endpoint": endpoint,
+        "completion_window": BATCH_COMPLETION_WINDOW
+    }
+    if metadata:
+        payload["metadata"] = metadata
+
+    for attempt in range(client.max_retries + 1):
+        try:
+            batch = client.request("POST", "batches", max_retries=0, json=payload).json()
+            logger.info(f"Created batch {batch['id']} for file {input_file_id}")
+            return batch
+        except OpenAIAPIError as e:
+            if e.status_code is not None and e.status_code not in RETRY_STATUS_CODES:
+                raise
+            batch = find_batch_for_file(input_file_id)
+            if batch is not None:
+                logger.warning(f"Creating a batch for file {input_file_id} failed ({e}), using existing batch {batch['id']}")
+                return batch
+            if attempt == client.max_retries:
+                raise
+            wait = min(MAX_BACKOFF_SECONDS, 2 ** attempt)
+            logger.warning(f"{e} - no batch for file {input_file_id}, retrying in {wait}s ({attempt + 1}/{client.max_retries})")
+            time.sleep(wait)
+
+
+# Function to poll a batch until it reaches a final status
+def wait_for_batch(batch_id, poll_interval=None):
+    poll_interval = BATCH_POLL_INTERVAL if poll_interval is None else poll_interval
+    while True:
+        batch = get_openai_client().request("GET", f"batches/{batch_id}").json()
+        counts = batch.get("request_counts") or {}
+        logger.info(f"Batch {batch_id}: {batch['status']} "
+                    f"({counts.get('completed', 0)}/{counts.get('total', 0)} done, {counts.get('failed', 0)} failed)")
+        if batch["status"] in BATCH_FINAL_STATUSES:
+            return batch
+        time.sleep(poll_interval)
+
+
+# Function to download a file and return its JSONL lines as dicts
+def download_jsonl_file(file_id):
+    response = get_openai_client().request("GET", f"files/{file_id}/content")
+    return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+
+# Function to read the results of a finished batch.
+# Returns {custom_id: response body} for successful requests and {custom_id: error} for the rest.
+def download_batch_results(batch):
+    results, errors = {}, {}
+
+    if batch.get("output_file_id"):
+        for line in download_jsonl_file(batch["output_file_id"]):
+            response = line.get("response") or {}
+            if line.get("error") or response.get("status_code") != 200:
+                errors[line["custom_id"]] = line.get("error") or response.get("body")
+            else:
+                results[line["custom_id"]] = response["body"]
+
+    if batch.get("error_file_id"):
+        for line in download_jsonl_file(batch["error_file_id"]):
+            errors[line["custom_id"]] = line.get("error") or (line.get("response") or {}).get("body")
+
+    return results, errors
+
+
+# Function to split batch requests into parts within the request count and file size limits
+def split_batch_requests(batch_requests, max_requests=BATCH_MAX_REQUESTS, max_bytes=BATCH_MAX_BYTES):
+    parts, part, part_bytes = [], [], 0
+    for batch_request in batch_requests:
+        # Same encoding as write_batch_file(), one line per request
+        line_bytes = len(json.dumps(batch_request, ensure_ascii=False).encode("utf-8")) + 1
+        if part and (len(part) >= max_requests or part_bytes + line_bytes > max_bytes):
+            parts.append(part)
+            part, part_bytes = [], 0
+        part.append(batch_request)
+        part_bytes += line_bytes
+    if part:
+        parts.append(part)
+    return parts
+
+
+# Function to identify the requests of a batch, a stored batch is resumed only for the same requests
+def batch_digest(batch_requests):
+    digest = hashlib.sha256()
+    for batch_request in batch_requests:
+        digest.update(json.dumps(batch_request, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Function to run batch requests end to end: write file, upload, create, wait and download.
+# Requests over BATCH_MAX_REQUESTS or BATCH_MAX_BYTES are split into several batches.
+# With a journal every created batch is stored under file_path, and a restarted run waits for
+# it instead of submitting it again. Call journal.clear_batches(file_path) once the results are processed.
+def run_batch(batch_requests, file_path, endpoint="/v1/chat/completions", poll_interval=None, metadata=None, journal=None):
+    results, errors = {}, {}
+    file_root, file_ext = os.path.splitext(file_path)
+    logger.info(f"Batch projection: {format_estimate(estimate_payloads((r['body'] for r in batch_requests), batch_api=True))}")
+
+    parts = split_batch_requests(batch_requests)
+    for index, part in enumerate(parts):
+        part_path = file_path if len(parts) == 1 else f"{file_root}.{index + 1}{file_ext}"
+        digest = batch_digest(part)
+
+        submitted = journal.get_batch(file_path, index) if journal else None
+        if submitted and submitted["digest"] == digest:
+            logger.info(f"Resuming batch {submitted['batch_id']} of {part_path}")
+            batch_id = submitted["batch_id"]
+        else:
+            if submitted:
+                logger.warning(f"Stored batch {submitted['batch_id']} of {part_path} has other requests, submitting a new one")
+            write_batch_file(part_path, part)
+            input_file_id = upload_batch_file(part_path)
+            batch_id = create_batch(input_file_id, endpoint, metadata)["id"]
+            if journal:
+                journal.record_batch(file_path, index, digest, input_file_id, batch_id)
+
+        batch = wait_for_batch(batch_id, poll_interval)
+
+        if batch["status"] != "completed":
+            logger.error(f"Batch {batch['id']} ended with status {batch['status']}: {batch.get('errors')}")
+
+        part_results, part_errors = download_batch_results(batch)
+        results.update(part_results)
+        errors.update(part_errors)
+
+        # Requests without any line in output or error file are reported as missing
+        for batch_request in part:
+            custom_id = batch_request["custom_id"]
+            if custom_id not in results and custom_id not in errors:
+                errors[custom_id] = f"No result, batch status {batch['status']}"
+
+    return results, errors
+
+
+# Function to get the assistant message content of a chat completion body
+def chat_completion_content(body):
+    choices = body.get("choices") if body else None
+    if not choices:
+        raise OpenAIAPIError(f"No choices in batch response: {body}", response_json=body)
+    return choices[0]["message"]["content"]
@@ -0,0 +1,158 @@
+import json
+import itertools
+import email.parser
+import email.policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI files/batches/chat endpoints, used to try the Batch API mode
+# without paying for it. Run it and point the scripts to it in .env:
+#   python batchApiStandIn.py 8085
+#   OPENAI_BASE_URL=http://127.0.0.1:8085/v1
+# Every chat request is answered with STANDIN_CONTENT.
+
+STANDIN_CONTENT = json.dumps({
+    "description_parts": [
+        {
+            "capd_desc_order": 1,
+            "capd_desc_text": "<img src=\"img_id:1\">",
+            "capd_desc_text2": "<p>Opis testowy</p>"
+        }
+    ]
+}, ensure_ascii=False)
+
+files = {}
+batches = {}
+ids = itertools.count(1)
+
+
+def chat_completion_body(request_body):
+    return {
+        "id": f"chatcmpl-{next(ids)}",
+        "object": "chat.completion",
+        "model": request_body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": STANDIN_CONTENT}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    }
+
+
+def run_batch(batch):
+    output_lines = []
+    for line in files[batch["input_file_id"]].splitlines():
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        output_lines.append(json.dumps({
+            "id": f"batch_req_{next(ids)}",
+            "custom_id": request["custom_id"],
+            "response": {"status_code": 200, "body": chat_completion_body(request["body"])},
+            "error": None
+        }, ensure_ascii=False))
+
+    output_file_id = f"file-{next(ids)}"
+    files[output_file_id] = "\n".join(output_lines) + "\n"
+    batch.update({
+        "status": "completed",
+        "output_file_id": output_file_id,
+        "request_counts": {"total": len(output_lines), "completed": len(output_lines), "failed": 0}
+    })
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, request_body):
+        # Server-sent events with STANDIN_CONTENT split into small deltas, then usage and [DONE]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        chunk_id = f"chatcmpl-{next(ids)}"
+        for start in range(0, len(STANDIN_CONTENT), 8):
+            delta = {"content": STANDIN_CONTENT[start:start + 8]}
+            event = {"id": chunk_id, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta}]}
+            self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        self.wfile.write(f"data: {json.dumps({'id': chunk_id, 'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        body = self.read_body()
+
+        if self.path == "/v1/files":
+            # Multipart upload, only the "file" field is needed
+            message = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+            )
+            for part in message.iter_parts():
+                if part.get_param("name", header="content-disposition") == "file":
+                    file_id = f"file-{next(ids)}"
+                    files[file_id] = part.get_payload(decode=True).decode("utf-8")
+                    return self.send_json(200, {"id": file_id, "object": "file", "purpose": "batch"})
+            return self.send_json(400, {"error": {"message": "file is missing"}})
+
+        if self.path == "/v1/batches":
+            payload = json.loads(body)
+            batch_id = f"batch_{next(ids)}"
+            batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": payload["endpoint"],
+                "input_file_id": payload["input_file_id"],
+                "status": "validating",
+                "request_counts": {"total": 0, "completed": 0, "failed": 0}
+            }
+            return self.send_json(200, batches[batch_id])
+
+        if self.path == "/v1/chat/completions":
+            request_body = json.loads(body)
+            if request_body.get("stream"):
+                return self.send_stream(request_body)
+            return self.send_json(200, chat_completion_body(request_body))
+
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+
+        if parts == ["v1", "batches"]:
+            # Newest first, like the API list
+            return self.send_json(200, {"object": "list", "data": list(reversed(batches.values()))})
+
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in batches:
+            batch = batches[parts[2]]
+            # First poll reports progress, the next one finishes the batch
+            if batch["status"] == "validating":
+                batch["status"] = "in_progress"
+            elif batch["status"] == "in_progress":
+                run_batch(batch)
+            return self.send_json(200, batch)
+
+        if parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content" and parts[2] in files:
+            body = files[parts[2]].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/jsonl")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+
+def main(port=8085):
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    print(f"Batch API stand-in listening on http://127.0.0.1:{port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8085)
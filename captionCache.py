@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()  # Settings below can be overridden in .env
+
+# Disk cache for image captions, shared by v1.4 and the dataset builder
+CAPTION_CACHE_PATH = os.getenv('CAPTION_CACHE_PATH', 'caption_cache.sqlite3')
+CAPTION_CACHE_TTL_DAYS = float(os.getenv('CAPTION_CACHE_TTL_DAYS', 90))
+CAPTION_CACHE_MAX_ENTRIES = int(os.getenv('CAPTION_CACHE_MAX_ENTRIES', 200000))
+
+# How many inserts happen between eviction passes
+EVICTION_INTERVAL = 500
+
+logger = logging.getLogger(__name__)
+
+
+# SQLite cache of image captions keyed by (url, model, prompt_version).
+# Entries older than ttl_days are treated as missing, and when the cache
+# grows over max_entries the least recently used captions are removed.
+class CaptionCache:
+    def __init__(self, path=CAPTION_CACHE_PATH, ttl_days=CAPTION_CACHE_TTL_DAYS, max_entries=CAPTION_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_days * 86400
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._inserts_since_eviction = 0
+
+        # Captions are requested from worker threads, access is serialized by the lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS captions (
+                url TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                description TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (url, model, prompt_version)
+            )
+        """)
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_captions_last_used ON captions (last_used)")
+        self._connection.commit()
+        self.evict()
+
+    def get(self, url, model, prompt_version):
+        if not url:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT description, created_at FROM captions WHERE url = ? AND model = ? AND prompt_version = ?",
+                (url, model, prompt_version)
+            ).fetchone()
+            if row is None:
+                return None
+
+            description, created_at = row
+            if self.ttl_seconds > 0 and now - created_at > self.ttl_seconds:
+                self._connection.execute(
+                    "DELETE FROM captions WHERE url = ? AND model = ? AND prompt_version = ?",
+                    (url, model, prompt_version)
+                )
+                self._connection.commit()
+                return None
+
+            self._connection.execute(
+                "UPDATE captions SET last_used = ? WHERE url = ? AND model = ? AND prompt_version = ?",
+                (now, url, model, prompt_version)
+            )
+            self._connection.commit()
+            return description
+
+    def set(self, url, model, prompt_version, description):
+        # Products without a valid image URL are never cached
+        if not url:
+            return
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO captions (url, model, prompt_version, description, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, model, prompt_version, description, now, now)
+            )
+            self._connection.commit()
+            self._inserts_since_eviction += 1
+            run_eviction = self._inserts_since_eviction >= EVICTION_INTERVAL
+
+        if run_eviction:
+            self.evict()
+
+    def evict(self):
+        with self._lock:
+            self._inserts_since_eviction = 0
+            if self.ttl_seconds > 0:
+                self._connection.execute("DELETE FROM captions WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+
+            count = self._connection.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+            if self.max_entries > 0 and count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM captions WHERE rowid IN (SELECT rowid FROM captions ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+                logger.info(f"Evicted {count - self.max_entries} least recently used captions")
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+_caption_cache = None
+_caption_cache_lock = threading.Lock()
+
+
+# Function to get the process-wide caption cache (opened on first use)
+def get_caption_cache():
+    global _caption_cache
+    with _caption_cache_lock:
+        if _caption_cache is None:
+            _caption_cache = CaptionCache()
+        return _caption_cache
@@ -0,0 +1,160 @@
+import os
+import re
+import json
+import random
+import hashlib
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()  # Settings below can be overridden in .env
+
+# Near-duplicate removal for the fine-tuning dataset. Product variants (colors, sizes) often
+# have almost the same description, and every copy costs fine-tuning tokens. Examples are
+# compared by the text of their assistant description_parts: word shingles -> MinHash
+# signature -> LSH buckets, and an example whose estimated similarity to an already kept
+# one reaches the threshold is dropped. The file is read line by line, only signatures of
+# kept examples stay in memory.
+DEDUPE_THRESHOLD = float(os.getenv('DEDUPE_THRESHOLD', 0.85))  # estimated Jaccard similarity
+DEDUPE_NUM_PERM = int(os.getenv('DEDUPE_NUM_PERM', 128))  # MinHash signature length
+DEDUPE_SHINGLE_SIZE = int(os.getenv('DEDUPE_SHINGLE_SIZE', 5))  # words per shingle
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+HTML_TAG_REGEX = re.compile(r"<[^>]*>")
+IMG_ID_REGEX = re.compile(r"img_id:\d+")
+WORD_REGEX = re.compile(r"\w+")
+
+
+# Function to get the plain text of the assistant description_parts of one dataset example
+def description_text(example):
+    for message in example.get("messages", []):
+        if message["role"] == "assistant":
+            parts = json.loads(message["content"]).get("description_parts", [])
+            texts = []
+            for part in parts:
+                texts.append(part.get("capd_desc_text") or "")
+                texts.append(part.get("capd_desc_text2") or "")
+            # Markup and image ids say nothing about the description itself
+            return IMG_ID_REGEX.sub(" ", HTML_TAG_REGEX.sub(" ", " ".join(texts)))
+    return ""
+
+
+# Function to split a text into hashed word shingles
+def shingles(text, size=DEDUPE_SHINGLE_SIZE):
+    words = WORD_REGEX.findall(text.lower())
+    if len(words) < size:
+        words = words and [" ".join(words)]
+        size = 1
+    return {
+        int.from_bytes(hashlib.blake2b(" ".join(words[i:i + size]).encode("utf-8"), digest_size=4).digest(), "little")
+        for i in range(len(words) - size + 1)
+    }
+
+
+class MinHasher:
+    def __init__(self, num_perm=DEDUPE_NUM_PERM, seed=1):
+        # Fixed seed, so signatures do not depend on the run
+        rng = random.Random(seed)
+        self.permutations = [
+            (rng.randint(1, MERSENNE_PRIME - 1), rng.randint(0, MERSENNE_PRIME - 1)) for _ in range(num_perm)
+        ]
+
+    def signature(self, shingle_hashes):
+        if not shingle_hashes:
+            return None
+        return tuple(
+            min(((a * value + b) % MERSENNE_PRIME) & MAX_HASH for value in shingle_hashes)
+            for a, b in self.permutations
+        )
+
+
+# Function to choose LSH bands x rows for the threshold, the S-curve turns at about (1/bands)^(1/rows)
+def lsh_bands(num_perm, threshold):
+    candidates = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return min(candidates, key=lambda band_rows: abs((1 / band_rows[0]) ** (1 / band_rows[1]) - threshold))
+
+
+def estimated_similarity(signature, other_signature):
+    return sum(1 for a, b in zip(signature, other_signature) if a == b) / len(signature)
+
+
+class NearDuplicateIndex:
+    def __init__(self, threshold=DEDUPE_THRESHOLD, num_perm=DEDUPE_NUM_PERM):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm)
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        self.buckets = [{} for _ in range(self.bands)]
+        self.signatures = {}
+
+    # Function to find a kept example similar to the signature, returns its key or None
+    def find_duplicate(self, signature):
+        checked = set()
+        for band, bucket in enumerate(self.buckets):
+            for key in bucket.get(signature[band * self.rows:(band + 1) * self.rows], ()):
+                if key in checked:
+                    continue
+                checked.add(key)
+                if estimated_similarity(signature, self.signatures[key]) >= self.threshold:
+                    return key
+        return None
+
+    def add(self, key, signature):
+        self.signatures[key] = signature
+        for band, bucket in enumerate(self.buckets):
+            bucket.setdefault(signature[band * self.rows:(band + 1) * self.rows], []).append(key)
+
+
+# Function to copy a JSONL dataset without near-duplicate examples, the first example of a group is kept.
+# Returns the number of kept and removed examples.
+def dedupe_dataset(input_file, output_file, threshold=DEDUPE_THRESHOLD, num_perm=DEDUPE_NUM_PERM, report_file=None):
+    index = NearDuplicateIndex(threshold, num_perm)
+    kept = removed = 0
+    report = open(report_file, "w", encoding="utf-8") if report_file else None
+
+    with open(input_file, "r", encoding="utf-8") as source, open(output_file, "w", encoding="utf-8") as target:
+        for line_number, line in enumerate(source, start=1):
+            if not line.strip():
+                continue
+            try:
+                signature = index.hasher.signature(shingles(description_text(json.loads(line))))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                print(f"Error decoding JSON line {line_number}, kept without dedupe")
+                signature = None
+
+            duplicate_of = index.find_duplicate(signature) if signature else None
+            if duplicate_of is not None:
+                removed += 1
+                if report:
+                    report.write(json.dumps({"line": line_number, "duplicate_of_line": duplicate_of}) + "\n")
+                continue
+
+            if signature:
+                index.add(line_number, signature)
+            target.write(line)
+            kept += 1
+
+    if report:
+        report.close()
+    print(f"Kept {kept} examples, removed {removed} near-duplicates (threshold {threshold}) -> {output_file}")
+    return kept, removed
+
+
+# Function to parse command line arguments
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Remove near-duplicate examples from a fine-tuning JSONL dataset.")
+    parser.add_argument("input", help="Dataset JSONL file")
+    parser.add_argument("output", help="Deduplicated JSONL file")
+    parser.add_argument("--threshold", type=float, default=DEDUPE_THRESHOLD, help="Similarity from which examples are duplicates")
+    parser.add_argument("--num-perm", type=int, default=DEDUPE_NUM_PERM, help="MinHash signature length")
+    parser.add_argument("--report", help="JSONL file with removed lines and the line they duplicate")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    dedupe_dataset(args.input, args.output, args.threshold, args.num_perm, args.report)
+
+
+if __name__ == "__main__":
+    main()
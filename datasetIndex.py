@@ -0,0 +1,82 @@
+import os
+import json
+
+# Sidecar index of the fine-tuning dataset: product_id -> byte offset of its line, stored
+# together with the dataset size and mtime. The dataset builder reads it at startup instead
+# of parsing the whole JSONL file, the file is scanned again only when the index is stale.
+INDEX_SUFFIX = ".idx.json"
+
+
+# Function to read the product_id from the user message of one dataset line
+def product_id_from_line(line):
+    data = json.loads(line)
+    for message in data.get("messages", []):
+        if message["role"] == "user":
+            product_id = json.loads(message["content"]).get("product_id")
+            if product_id:
+                return int(product_id)
+    return None
+
+
+class DatasetIndex:
+    def __init__(self, dataset_path):
+        self.dataset_path = dataset_path
+        self.index_path = dataset_path + INDEX_SUFFIX
+        self.offsets = {}
+        if not self._load():
+            self.rebuild()
+
+    def _dataset_stat(self):
+        try:
+            stat = os.stat(self.dataset_path)
+        except FileNotFoundError:
+            return None
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _load(self):
+        # The index is used only if it describes the dataset file as it is now
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        if index.get("dataset") != self._dataset_stat():
+            return False
+        self.offsets = {int(product_id): offset for product_id, offset in index.get("offsets", {}).items()}
+        return True
+
+    # Function to scan the dataset line by line and index it again
+    def rebuild(self):
+        self.offsets = {}
+        if os.path.exists(self.dataset_path):
+            print(f"Rebuilding dataset index {self.index_path}")
+            with open(self.dataset_path, "rb") as file:
+                offset = 0
+                for line in file:
+                    try:
+                        product_id = product_id_from_line(line)
+                        if product_id and product_id not in self.offsets:
+                            self.offsets[product_id] = offset
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        print(f"Error decoding JSON line at byte {offset}")
+                    offset += len(line)
+        self.save()
+
+    def product_ids(self):
+        return set(self.offsets)
+
+    # Function to register a line appended to the dataset, call save() once the file is closed
+    def add(self, product_id, offset):
+        self.offsets.setdefault(int(product_id), offset)
+
+    def save(self):
+        index = {
+            "dataset": self._dataset_stat(),
+            "offsets": {str(product_id): offset for product_id, offset in self.offsets.items()}
+        }
+        # Write to a temporary file first, so an interrupted save never leaves a broken index
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(index, file)
+        os.replace(temporary_path, self.index_path)
@@ -0,0 +1,84 @@
+import re
+import json
+
+# Schema of the generation response. It is sent as response_format (structured outputs),
+# so the API only returns JSON in this shape, and the local validator below checks what a
+# schema can not: image ids must be ones the product has, and every image is used once.
+DESCRIPTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "description_parts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "capd_desc_order": {"type": "integer", "description": "Kolejność części opisu, od 1"},
+                    "capd_desc_text": {"type": "string", "description": "Lewa strona opisu (HTML), zdjęcia jako <img src=\"img_id:id\">"},
+                    "capd_desc_text2": {"type": "string", "description": "Prawa strona opisu (HTML), zdjęcia jako <img src=\"img_id:id\">"}
+                },
+                "required": ["capd_desc_order", "capd_desc_text", "capd_desc_text2"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["description_parts"],
+    "additionalProperties": False
+}
+
+PART_TEXT_FIELDS = ("capd_desc_text", "capd_desc_text2")
+# Image placeholder in description texts, whole tokens only: ximg_id:1 and img_id:1x are not placeholders
+IMG_ID_REGEX = re.compile(r"\bimg_id:(\d+)\b")
+
+
+class DescriptionValidationError(ValueError):
+    pass
+
+
+# Function to build the response_format of a generation request
+def description_response_format():
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "product_description", "strict": True, "schema": DESCRIPTION_SCHEMA}
+    }
+
+
+# Function to check one description part, known_img_ids=None skips the image id check.
+# used_img_ids collects the ids of the parts checked so far, to catch images used twice.
+def validate_description_part(part, known_img_ids=None, used_img_ids=None):
+    if not isinstance(part, dict):
+        raise DescriptionValidationError(f"Description part is not an object: {part!r}")
+    if not isinstance(part.get("capd_desc_order"), int):
+        raise DescriptionValidationError(f"Description part without integer capd_desc_order: {part!r}")
+
+    for field in PART_TEXT_FIELDS:
+        if not isinstance(part.get(field), str):
+            raise DescriptionValidationError(f"Description part {part['capd_desc_order']} without text in {field}")
+        for img_id in IMG_ID_REGEX.findall(part[field]):
+            img_id = int(img_id)
+            if known_img_ids is not None and img_id not in known_img_ids:
+                raise DescriptionValidationError(f"Unknown img_id:{img_id} in description part {part['capd_desc_order']}")
+            if used_img_ids is not None:
+                if img_id in used_img_ids:
+                    raise DescriptionValidationError(f"img_id:{img_id} used more than once")
+                used_img_ids.add(img_id)
+
+
+# Function to check a whole parsed response before it is written, returns its description parts
+def validate_description(response_json, images=None):
+    if not isinstance(response_json, dict) or not isinstance(response_json.get("description_parts"), list):
+        raise DescriptionValidationError("Response is not an object with a description_parts list")
+
+    known_img_ids = {image["img_id"] for image in images} if images is not None else None
+    used_img_ids = set()
+    orders = set()
+    for part in response_json["description_parts"]:
+        validate_description_part(part, known_img_ids, used_img_ids)
+        if part["capd_desc_order"] in orders:
+            raise DescriptionValidationError(f"capd_desc_order {part['capd_desc_order']} used more than once")
+        orders.add(part["capd_desc_order"])
+    return response_json["description_parts"]
+
+
+# Function to parse and validate a raw assistant response
+def parse_description(assistant_response, images=None):
+    return validate_description(json.loads(assistant_response), images)
@@ -0,0 +1,93 @@
+import json
+from descriptionSchema import DescriptionValidationError, validate_description_part
+
+# Incremental parser of a streamed generation response. The model answers with
+#   {"description_parts": [{...}, {...}]}
+# and every part is parsed and checked as soon as its closing brace arrives, so a broken
+# response can be aborted after its first bad part instead of after the whole completion.
+# Parts are checked with the same rules as whole responses (descriptionSchema.py).
+RESPONSE_PREFIX = '{"description_parts":['
+
+
+class DescriptionStreamError(DescriptionValidationError):
+    pass
+
+
+class DescriptionPartsParser:
+    def __init__(self, known_img_ids=None):
+        self.known_img_ids = set(known_img_ids) if known_img_ids is not None else None
+        self.used_img_ids = set()
+        self.parts = []
+        self._buffer = []
+        self._state = "prefix"
+        self._prefix = ""
+        # State of the part object being read
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    # Function to add streamed text, returns the description parts completed by it
+    def feed(self, text):
+        completed = []
+        for char in text:
+            if self._state == "prefix":
+                self._read_prefix(char)
+            elif self._state == "part":
+                self._buffer.append(char)
+                if self._read_part_char(char):
+                    completed.append(self._finish_part())
+            elif self._state == "parts":
+                if char == "{":
+                    self._state, self._depth, self._buffer = "part", 1, [char]
+                elif char == "]":
+                    self._state = "end"
+                elif not (char.isspace() or char == ","):
+                    raise DescriptionStreamError(f"Unexpected {char!r} between description parts")
+            elif not (char.isspace() or char == "}"):
+                raise DescriptionStreamError(f"Unexpected {char!r} after description parts")
+        return completed
+
+    def _read_prefix(self, char):
+        # Whitespace between the tokens of the prefix does not matter
+        if char.isspace():
+            return
+        self._prefix += char
+        if not RESPONSE_PREFIX.startswith(self._prefix):
+            raise DescriptionStreamError(f"Response does not start with {RESPONSE_PREFIX}: {self._prefix!r}")
+        if self._prefix == RESPONSE_PREFIX:
+            self._state = "parts"
+
+    # Function to track strings and nesting of the part object, returns True when it is closed
+    def _read_part_char(self, char):
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+        elif char == '"':
+            self._in_string = True
+        elif char == "{":
+            self._depth += 1
+        elif char == "}":
+            self._depth -= 1
+            return self._depth == 0
+        return False
+
+    def _finish_part(self):
+        try:
+            part = json.loads("".join(self._buffer))
+        except json.JSONDecodeError as e:
+            raise DescriptionStreamError(f"Invalid JSON in description part {len(self.parts) + 1}: {e}")
+        try:
+            validate_description_part(part, self.known_img_ids, self.used_img_ids)
+        except DescriptionValidationError as e:
+            raise DescriptionStreamError(str(e)) from e
+        self.parts.append(part)
+        self._state, self._buffer = "parts", []
+        return part
+
+    @property
+    def finished(self):
+        return self._state == "end"
@@ -21,6 +21,10 @@ client = OpenAI()
 
 
 # ============================================2==============================================
+# # Check the size and projected cost of the dataset before training (also: python tokenCount.py fine_tune_chat_dataset.jsonl)
+# from tokenCount import print_dataset_estimate
+# print_dataset_estimate("fine_tune_chat_dataset.jsonl", model="gpt-4o-2024-08-06")
+
 # # CREATE FINE-TUNING JOB
 # response = client.fine_tuning.jobs.create(
 #   training_file="file-xpwFa5rPgofDhRJjTSJGW96f",
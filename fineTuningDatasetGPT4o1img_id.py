@@ -1,10 +1,17 @@
 import mysql.connector
 import json
 import os
-import requests
 from dotenv import load_dotenv
+from captionCache import get_caption_cache
+from openaiClient import get_openai_client, OpenAIAPIError
+from datasetIndex import DatasetIndex
+from datasetDedupe import dedupe_dataset, DEDUPE_THRESHOLD
+from prompts import CAPTION_PROMPT_VERSION, caption_prompt, system_prompt
 import random
 import re
+import heapq
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 # Load the API key from the .env file
 load_dotenv()  # Load environment variables from .env file
@@ -21,58 +28,59 @@ DB_CONFIG = {
 # Dictionary to store image URLs by img_id for later reference
 image_url_dict = {}
 
+# Dataset builder settings: number of sampled products, parallel workers and seed of the sample (empty = random)
+DATASET_LIMIT = int(os.getenv('DATASET_LIMIT', 1))
+DATASET_WORKERS = int(os.getenv('DATASET_WORKERS', 4))
+DATASET_SEED = int(os.getenv('DATASET_SEED')) if os.getenv('DATASET_SEED') else None
+
+# Vision model used for captions (caption prompt and its version are in prompts.py)
+CAPTION_MODEL = "gpt-4o-2024-08-06"
+
 
 # Function to extract product IDs from the existing fine-tuning dataset
 def extract_product_ids_from_file(file_path):
-    existing_product_ids = set()
-    if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as file:
-            for line in file:
-                try:
-                    data = json.loads(line.strip())
-                    for message in data.get("messages", []):
-                        if message["role"] == "user":
-                            user_data = json.loads(message["content"])
-                            product_id = user_data.get("product_id")
-                            if product_id:
-                                existing_product_ids.add(int(product_id))
-                except json.JSONDecodeError:
-                    print("Error decoding JSON line")
-    return existing_product_ids
-
-
-# Function to get product information, including materials and additional info
-def get_product_info_with_materials_and_producer(limit=1):
+    # Read from the index sidecar, the dataset itself is scanned only when the index is stale
+    return DatasetIndex(file_path).product_ids()
+
+
+# Function to get product information, including materials and additional info.
+# Sampling is done by the database: only `limit` random products that are not in the dataset yet are returned.
+def get_product_info_with_materials_and_producer(limit=1, existing_product_ids=None, seed=None):
     connection = mysql.connector.connect(**DB_CONFIG)
     cursor = connection.cursor()
 
-    # Query to fetch product information, materials, sizes, and producer
-    query = """
+    # Extract existing product IDs from the fine-tuning file
+    if existing_product_ids is None:
+        existing_product_ids = extract_product_ids_from_file("fine_tune_chat_dataset.jsonl")
+
+    # Skip products that are already in the fine-tuning dataset
+    params = list(existing_product_ids)
+    exclude_existing = ""
+    if params:
+        exclude_existing = f"AND CA_CW_ID NOT IN ({', '.join(['%s'] * len(params))})"
+
+    # RAND(seed) gives the same sample for the same seed and dataset
+    order_by = "RAND()" if seed is None else "RAND(%s)"
+    if seed is not None:
+        params.append(int(seed))
+    params.append(int(limit))
+
+    # Query to fetch a random sample of products with materials, sizes and producer
+    query = f"""
     SELECT CA_CW_ID, CA_TYTUL, ca_filters_material1, ca_filters_material2, ca_filters_material3,
            ca_filters_wysokosc, ca_filters_dlugosc, ca_filters_szerokosc, ca_filters_glebokosc,
-           ca_filters_srednica, ca_filters_pojemnosc, CA_PRODUCENT_ID
+           ca_filters_srednica, ca_filters_pojemnosc, CP_NAZWA
     FROM cms_art_produkty
-    WHERE ca_is_multitext = 1 AND CA_AKTYWNY = 'T'
+    LEFT JOIN cms_producenci ON CP_ID = CA_PRODUCENT_ID
+    WHERE ca_is_multitext = 1 AND CA_AKTYWNY = 'T' {exclude_existing}
+    ORDER BY {order_by}
+    LIMIT %s
     """
-    cursor.execute(query)
+    cursor.execute(query, tuple(params))
     products = cursor.fetchall()
 
-    # Shuffle the products to introduce randomness
-    random.shuffle(products)
-
-    # Extract existing product IDs from the fine-tuning file
-    existing_product_ids = extract_product_ids_from_file("fine_tune_chat_dataset.jsonl")
-
     product_info_list = []
     for product in products:
-        # Skip the product if it's already in the fine-tuning dataset
-        if product[0] in existing_product_ids:
-            continue
-
-        # Query to fetch the producer name based on CA_PRODUCENT_ID
-        cursor.execute(f"SELECT CP_NAZWA FROM cms_producenci WHERE CP_ID = '{product[11]}'")
-        producer = cursor.fetchone()
-        
         product_info = {
             "product_id": product[0],
             "product_name": product[1],
@@ -89,14 +97,10 @@ def get_product_info_with_materials_and_producer(limit=1):
                 "średnica": product[9] if product[9] else "brak informacji",
                 "pojemność": product[10] if product[10] else "brak informacji",
             },
-            "producent": producer[0] if producer else "brak informacji"
+            "producent": product[11] if product[11] else "brak informacji"
         }
-        
-        product_info_list.append(product_info)
 
-        # Stop adding products once we've reached the specified limit
-        if len(product_info_list) >= limit:
-            break
+        product_info_list.append(product_info)
 
     cursor.close()
     connection.close()
@@ -155,16 +159,15 @@ def get_product_images(product_id):
 
 # Function to send an image URL to GPT-4 Vision API and get a description
 def send_image_url_to_gpt_vision(image_url):
-    return "Generated_description"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+    cache = get_caption_cache()
+    cached_description = cache.get(image_url, CAPTION_MODEL, CAPTION_PROMPT_VERSION)
+    if cached_description is not None:
+        return cached_description
 
-    prompt = f"Opis zdjęcia produktu dla sklepu internetowego. Krótko opisz to co jest na zdjęciu.\nZdjęcie: {image_url}"
+    prompt = caption_prompt(image_url)
 
     payload = {
-        "model": "gpt-4o-2024-08-06",  # Use GPT-4 or your fine-tuned model
+        "model": CAPTION_MODEL,  # Use GPT-4 or your fine-tuned model
         "messages": [
             {
                 "role": "user",
@@ -174,13 +177,11 @@ def send_image_url_to_gpt_vision(image_url):
         "max_tokens": 150  # Limit to 150 tokens for the description
     }
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    response_json = response.json()
-
-    if 'choices' in response_json:
-        return response_json['choices'][0]['message']['content']
-    else:
-        return "Description not available"
+    # Rate limits, retries and backoff are handled by the shared client, errors are raised
+    response_json = get_openai_client().chat_completion(payload, timeout=(10, 60))
+    description = response_json['choices'][0]['message']['content']
+    cache.set(image_url, CAPTION_MODEL, CAPTION_PROMPT_VERSION, description)
+    return description
 
 
 # Function to process images and add their descriptions to the existing images dictionary
@@ -191,6 +192,9 @@ def process_images_with_descriptions(images):
         try:
             description = send_image_url_to_gpt_vision(image_url)  # Get description from GPT-4 Vision
             image['description'] = description  # Add description to the existing image dictionary
+        except OpenAIAPIError:
+            # Retries are exhausted, skip the product instead of training on a missing caption
+            raise
         except Exception as e:
             print(f"Error processing {image_url}: {e}")
             image['description'] = "Description not available"  # Default if there's an error
@@ -227,183 +231,217 @@ def get_product_descriptions(product_id):
     return description_parts
 
 
-# Function to replace all URLs in description parts with their corresponding img_id or a random img_id
-def replace_urls_with_img_ids(descriptions, image_descriptions):
-    # Create a mapping from URLs to img_ids
-    url_to_img_id = {image['url']: image['img_id'] for image in image_descriptions}
-
-    # Define a regex to match URLs
-    url_regex = r'https?://[^\s\'"<>]+'
-
-    # List of all img_ids to use if we need random replacements
-    img_ids = [image['img_id'] for image in image_descriptions]
-    used_img_ids = set()  # To keep track of used img_ids
-
-    for part in descriptions:
-        # Replace known URLs in 'capd_desc_text'
-        capd_desc_text = part.get("capd_desc_text", "")
-        urls_in_text = re.findall(url_regex, capd_desc_text)
-
-        for url in urls_in_text:
-            img_id = url_to_img_id.get(url)  # Get img_id for the found URL
-            if img_id:
-                img_id_placeholder = f"img_id:{img_id}"
-                # Replace the known URL with img_id placeholder
-                capd_desc_text = capd_desc_text.replace(url, img_id_placeholder)
-            else:
-                # Find an unused img_id or loop back if all are used
-                available_img_ids = [img_id for img_id in img_ids if img_id not in used_img_ids]
-                if available_img_ids:
-                    random_img_id = random.choice(available_img_ids)
-                    used_img_ids.add(random_img_id)  # Mark this img_id as used
-                else:
-                    # If all img_ids are used, reset the set and allow reuse
-                    used_img_ids.clear()
-                    random_img_id = random.choice(img_ids)
-                    used_img_ids.add(random_img_id)  # Mark this img_id as used
-
-                random_img_id_placeholder = f"img_id:{random_img_id}"
-                print(f"Replacing unknown {url} with {random_img_id_placeholder}")
-                capd_desc_text = capd_desc_text.replace(url, random_img_id_placeholder)
-        part["capd_desc_text"] = capd_desc_text
-
-        # Replace known URLs in 'capd_desc_text2'
-        capd_desc_text2 = part.get("capd_desc_text2", "")
-        urls_in_text2 = re.findall(url_regex, capd_desc_text2)
-
-        for url in urls_in_text2:
-            img_id = url_to_img_id.get(url)  # Get img_id for the found URL
-            if img_id:
-                img_id_placeholder = f"img_id:{img_id}"
-                # Replace the known URL with img_id placeholder
-                capd_desc_text2 = capd_desc_text2.replace(url, img_id_placeholder)
-            else:
-                # Find an unused img_id or loop back if all are used
-                available_img_ids = [img_id for img_id in img_ids if img_id not in used_img_ids]
-                if available_img_ids:
-                    random_img_id = random.choice(available_img_ids)
-                    used_img_ids.add(random_img_id)  # Mark this img_id as used
-                else:
-                    # If all img_ids are used, reset the set and allow reuse
-                    used_img_ids.clear()
-                    random_img_id = random.choice(img_ids)
-                    used_img_ids.add(random_img_id)  # Mark this img_id as used
-
-                random_img_id_placeholder = f"img_id:{random_img_id}"
-                print(f"Replacing unknown {url} with {random_img_id_placeholder}")
-                capd_desc_text2 = capd_desc_text2.replace(url, random_img_id_placeholder)
-        part["capd_desc_text2"] = capd_desc_text2
-
-    return descriptions
-
-
-# Function to create the JSONL dataset with materials and producer information
-def create_fine_tune_dataset(output_file="fine_tune_chat_dataset.jsonl"):
-    products = get_product_info_with_materials_and_producer()
-
-    with open(output_file, "a", encoding="utf-8") as file:
-        for product in products:
-            product_id = product["product_id"]
-            product_name = product["product_name"]
-            materials = product["materials"]
-            sizes = product["sizes"]
-            producer = product["producent"]
-
-            # Get product images (with URLs)
-            images = get_product_images(product_id)
-
-            # Process images and add descriptions directly to the images dictionary
-            images_with_descriptions = process_images_with_descriptions(images)
-
-            # Get product descriptions (left and right sides) from the database
-            descriptions = get_product_descriptions(product_id)
-
-            # Check if there are description parts, if not, skip this product
-            if not descriptions:
-                print(f"No descriptions found for product ID {product_id}")
-                continue
-
-            # Replace URLs with img_id in description parts
-            descriptions_with_img_ids = replace_urls_with_img_ids(descriptions, images_with_descriptions)
-
-            # Create the system prompt with the updated structure
-            system_prompt = """
-Jesteś asystentem sklepu e-commerce. Twoim zadaniem jest tworzenie atrakcyjnych opisów produktów w strukturze:
+# URLs in historic descriptions, compiled once
+URL_REGEX = re.compile(r'https?://[^\s\'"<>]+')
+
+
+# Rewrites the image URLs of one product's descriptions into img_id placeholders. Known URLs get
+# their own img_id, unknown ones (images no longer attached to the product) get a free img_id
+# picked at random; when every id is taken they are all free again. The same unknown URL keeps
+# the id it got first. Pass a seeded random.Random as rng for reproducible datasets.
+class UrlToImgIdRewriter:
+    def __init__(self, images, rng=None):
+        self.rng = rng or random
+        self.url_to_img_id = {image['url']: image['img_id'] for image in images}
+        self.img_ids = list(dict.fromkeys(image['img_id'] for image in images))
+        self._reset_free_ids()
+
+    def _reset_free_ids(self):
+        # List for O(1) random choice and swap-remove, dict with positions for O(1) lookup
+        self.free_ids = list(self.img_ids)
+        self.free_positions = {img_id: position for position, img_id in enumerate(self.free_ids)}
+
+    def _take(self, img_id):
+        position = self.free_positions.pop(img_id, None)
+        if position is None:
+            return
+        last = self.free_ids.pop()
+        if last != img_id:
+            self.free_ids[position] = last
+            self.free_positions[last] = position
+
+    def _random_free_id(self):
+        if not self.img_ids:
+            raise ValueError("Product has no images to replace unknown URLs with")
+        if not self.free_ids:
+            # All img_ids are used, allow reuse
+            self._reset_free_ids()
+        img_id = self.free_ids[self.rng.randrange(len(self.free_ids))]
+        self._take(img_id)
+        return img_id
+
+    def _substitute(self, match):
+        url = match.group(0)
+        img_id = self.url_to_img_id.get(url)
+        if img_id is not None:
+            self._take(img_id)
+            return f"img_id:{img_id}"
+
+        img_id = self._random_free_id()
+        self.url_to_img_id[url] = img_id
+        print(f"Replacing unknown {url} with img_id:{img_id}")
+        return f"img_id:{img_id}"
+
+    def rewrite(self, text):
+        return URL_REGEX.sub(self._substitute, text or "")
+
+    def rewrite_parts(self, descriptions):
+        for part in descriptions:
+            part["capd_desc_text"] = self.rewrite(part.get("capd_desc_text", ""))
+            part["capd_desc_text2"] = self.rewrite(part.get("capd_desc_text2", ""))
+        return descriptions
 
-- **capd_cw_id**: ID produktu
-- **capd_desc_order**: kolejność części opisu
-- **capd_desct_text**: lewa strona opisu (z HTML)
-- **capd_desct_text2**: prawa strona opisu (z HTML)
 
-**Instrukcje:**
-
-1. Opracuj krótki opis produktu na podstawie podanych informacji. **Nie dodawaj niepewnych danych.**
-2. Wybierz najlepsze zdjęcia dla fragmentów opisu, aby wspierały tekst. **Rozmiar max: 600x600.**
-3. Zaplanuj, gdzie umieścić zdjęcia (lewo/prawo) dla najlepszej prezentacji.
-4. Stwórz opis używając struktury:
-
-{
-  "description_parts": [
-    {
-      "capd_desc_order": 1,
-      "capd_desc_text": "Treść dla lewej strony z HTML",
-      "capd_desc_text2": "Treść dla prawej strony z HTML"
+# Function to replace all URLs in description parts with their corresponding img_id or a random img_id
+def replace_urls_with_img_ids(descriptions, image_descriptions, rng=None):
+    return UrlToImgIdRewriter(image_descriptions, rng).rewrite_parts(descriptions)
+
+
+# Function to build one dataset example (system prompt, user input and assistant response) for a product
+def build_product_chat_data(product, seed=None):
+    product_id = product["product_id"]
+    product_name = product["product_name"]
+    materials = product["materials"]
+    sizes = product["sizes"]
+    producer = product["producent"]
+
+    # Get product images (with URLs)
+    images = get_product_images(product_id)
+
+    # Process images and add descriptions directly to the images dictionary
+    images_with_descriptions = process_images_with_descriptions(images)
+
+    # Get product descriptions (left and right sides) from the database
+    descriptions = get_product_descriptions(product_id)
+
+    # Check if there are description parts, if not, skip this product
+    if not descriptions:
+        print(f"No descriptions found for product ID {product_id}")
+        return None
+
+    # Replace URLs with img_id in description parts
+    # With a seed every product gets its own generator, so results do not depend on the worker that built it
+    rng = random.Random(f"{seed}:{product_id}") if seed is not None else None
+    descriptions_with_img_ids = replace_urls_with_img_ids(descriptions, images_with_descriptions, rng)
+
+    # Prepare the user message with product information
+    user_message = {
+        "product_id": product_id,
+        "product_name": product_name,
+        "producent_name": producer,
+        "materials": materials,
+        "sizes": sizes,
+        "images": [
+            {
+                "img_id": image["img_id"],
+                "description": image["description"]
+            } for image in images_with_descriptions
+        ]
     }
-    // Dodatkowe części według potrzeb
-  ]
-}
 
-**WAŻNE:**
-
-- **Pisz specyfikację tylko z dostępnych danych.**
-- Używaj **wyłącznie** podanych identyfikatorów obrazów. **Nie dodawaj ani nie generuj nowych linków; wstawiaj tylko id zdjęcia w postaci img src=\"img_id:id\
-, gdzie id to odpowiedni numer obrazu.**
-- Zachowaj odpowiednią strukturę HTML. **Nie pozostawiaj pustych pól.**
-- Zadbaj o estetykę, spójność i czytelność. Używaj symboli ✅, ⭐, ale bez przesady.
-- Jeśli jest jedno zdjęcie, utwórz **maksymalnie 1 sekcję**. Przy więcej niż 1 zdjęciu - **maksymalnie 3 sekcje.**
-- **Nie używaj tego samego zdjęcia więcej niż raz.**
-"""
-
-            # Prepare the user message with product information
-            user_message = {
-                "product_id": product_id,
-                "product_name": product_name,
-                "producent_name": producer,
-                "materials": materials,
-                "sizes": sizes,
-                "images": [
-                    {
-                        "img_id": image["img_id"],
-                        "description": image["description"]
-                    } for image in images_with_descriptions
-                ]
+    # Construct the chat data including the system prompt, user input, and assistant response
+    chat_data = {
+        "messages": [
+            {
+                "role": "system",
+                "content": system_prompt("full")  # same system prompt as v1.4 sends in full mode
+            },
+            {
+                "role": "user",
+                "content": json.dumps(user_message, ensure_ascii=False)
+            },
+            {
+                "role": "assistant",
+                "content": json.dumps({"description_parts": descriptions_with_img_ids}, ensure_ascii=False)
             }
+        ]
+    }
 
-            # Construct the chat data including the system prompt, user input, and assistant response
-            chat_data = {
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": system_prompt.strip()
-                    },
-                    {
-                        "role": "user",
-                        "content": json.dumps(user_message, ensure_ascii=False)
-                    },
-                    {
-                        "role": "assistant",
-                        "content": json.dumps({"description_parts": descriptions_with_img_ids}, ensure_ascii=False)
-                    }
-                ]
-            }
+    return chat_data
 
-            file.write(json.dumps(chat_data, ensure_ascii=False) + "\n")
 
+# Function to build the examples of one shard and write them into its own JSONL file.
+# Returns the positions (in the sample) of the products that were written, in file order.
+def build_dataset_shard(shard_file, shard_products, seed=None):
+    written_positions = []
+    with open(shard_file, "w", encoding="utf-8") as file:
+        for position, product in shard_products:
+            try:
+                chat_data = build_product_chat_data(product, seed)
+            except Exception as e:
+                print(f"Error building example for product ID {product['product_id']}: {e}")
+                continue
+            if chat_data is None:
+                continue
+            file.write(json.dumps(chat_data, ensure_ascii=False) + "\n")
+            written_positions.append(position)
+    return written_positions
+
+
+# Function to create the JSONL dataset with materials and producer information.
+# Products are spread over `workers` threads, each writing its own shard file; the shards are
+# merged into the dataset in sample order, so the same seed always gives the same file.
+def create_fine_tune_dataset(output_file="fine_tune_chat_dataset.jsonl", limit=None, workers=None, seed=None):
+    limit = DATASET_LIMIT if limit is None else limit
+    workers = max(1, DATASET_WORKERS if workers is None else workers)
+    seed = DATASET_SEED if seed is None else seed
+
+    dataset_index = DatasetIndex(output_file)
+    products = get_product_info_with_materials_and_producer(
+        limit=limit, existing_product_ids=dataset_index.product_ids(), seed=seed
+    )
+    if not products:
+        print("No new products for the dataset")
+        return
+
+    # Round-robin assignment keeps the shards balanced and independent of thread timing
+    workers = min(workers, len(products))
+    positioned_products = list(enumerate(products))
+    shard_files = [f"{output_file}.shard{index}" for index in range(workers)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        shard_positions = list(executor.map(
+            build_dataset_shard, shard_files, [positioned_products[index::workers] for index in range(workers)], [seed] * workers
+        ))
+
+    # Merge the shards ordered by sample position
+    shard_readers = [open(shard_file, "r", encoding="utf-8") for shard_file in shard_files]
+    try:
+        shard_lines = [zip(positions, reader) for positions, reader in zip(shard_positions, shard_readers)]
+        with open(output_file, "a", encoding="utf-8") as file:
+            for position, line in heapq.merge(*shard_lines, key=lambda item: item[0]):
+                # Remember the line offset so the index stays in sync with the appended dataset
+                dataset_index.add(products[position]["product_id"], file.tell())
+                file.write(line)
+    finally:
+        for reader in shard_readers:
+            reader.close()
+
+    # Saved after the file is closed, an interrupted run leaves a stale index that is rebuilt on next start
+    dataset_index.save()
+    for shard_file in shard_files:
+        os.remove(shard_file)
+
+    print(f"Added {sum(len(positions) for positions in shard_positions)} of {len(products)} products to {output_file}")
+
+
+# Function to parse command line arguments
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the fine-tuning dataset from existing product descriptions.")
+    parser.add_argument("--output", default="fine_tune_chat_dataset.jsonl", help="Dataset JSONL file, new examples are appended")
+    parser.add_argument("--limit", type=int, default=None, help="Number of products to sample (default DATASET_LIMIT)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of parallel workers (default DATASET_WORKERS)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the product sample (default DATASET_SEED, random when empty)")
+    parser.add_argument("--dedupe", help="After building, write the dataset without near-duplicate examples into this file")
+    parser.add_argument("--dedupe-threshold", type=float, default=DEDUPE_THRESHOLD, help="Similarity from which examples are duplicates")
+    return parser.parse_args(argv)
 
 
 # Main function to process all products and create the dataset
-def main():
-    create_fine_tune_dataset()
+def main(argv=None):
+    args = parse_args(argv)
+    create_fine_tune_dataset(args.output, limit=args.limit, workers=args.workers, seed=args.seed)
+    if args.dedupe:
+        dedupe_dataset(args.output, args.dedupe, threshold=args.dedupe_threshold)
 
 
 if __name__ == "__main__":
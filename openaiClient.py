@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import random
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from tokenCount import count_payload_tokens, estimate_cost
+
+load_dotenv()  # Settings below can be overridden in .env
+
+# Shared HTTP client for the OpenAI API used by v1.4 and the dataset builder
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1').rstrip('/')
+OPENAI_RPM_LIMIT = int(os.getenv('OPENAI_RPM_LIMIT', 500))  # requests per minute, 0 disables the limit
+OPENAI_TPM_LIMIT = int(os.getenv('OPENAI_TPM_LIMIT', 30000))  # tokens per minute, 0 disables the limit
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 6))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', 10))
+OPENAI_READ_TIMEOUT = float(os.getenv('OPENAI_READ_TIMEOUT', 120))
+
+# Status codes worth retrying: rate limit and transient server errors
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+MAX_BACKOFF_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+
+class OpenAIAPIError(Exception):
+    def __init__(self, message, status_code=None, response_json=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response_json = response_json
+
+
+# Token bucket refilled continuously up to `per_minute`, used for both RPM and TPM limits
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        if self.capacity <= 0:
+            return
+        # A single request bigger than the whole bucket would wait forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, amount):
+        # Correct an earlier estimate once the real usage is known (may go below zero)
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+# Token estimate of a chat payload (prompt counted locally, see tokenCount.py) plus the completion budget
+def estimate_payload_tokens(payload):
+    prompt_tokens, completion_tokens = count_payload_tokens(payload)
+    return prompt_tokens + completion_tokens
+
+
+def _retry_after_seconds(response, attempt):
+    # Prefer the server's hint, otherwise exponential backoff with jitter
+    if response is not None:
+        retry_after_ms = response.headers.get("retry-after-ms")
+        retry_after = response.headers.get("Retry-After")
+        try:
+            if retry_after_ms:
+                return float(retry_after_ms) / 1000
+            if retry_after:
+                return float(retry_after)
+        except ValueError:
+            pass
+    return min(MAX_BACKOFF_SECONDS, 2 ** attempt) + random.uniform(0, 1)
+
+
+class OpenAIClient:
+    def __init__(self, api_key=None, base_url=OPENAI_BASE_URL, rpm_limit=OPENAI_RPM_LIMIT, tpm_limit=OPENAI_TPM_LIMIT,
+                 max_retries=OPENAI_MAX_RETRIES, timeout=(OPENAI_CONNECT_TIMEOUT, OPENAI_READ_TIMEOUT)):
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.base_url = base_url.rstrip('/')
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.request_bucket = TokenBucket(rpm_limit)
+        self.token_bucket = TokenBucket(tpm_limit)
+        # Real usage reported by the API, per model
+        self.usage = {}
+        self._usage_lock = threading.Lock()
+
+        # Keep-alive session, connections are reused between calls and threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Authorization": f"Bearer {self.api_key}"})
+
+    # max_retries overrides the client setting for one call, 0 for requests that must not be repeated blindly
+    def request(self, method, path, estimated_tokens=0, timeout=None, max_retries=None, **kwargs):
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        max_retries = self.max_retries if max_retries is None else max_retries
+        last_error = None
+
+        for attempt in range(max_retries + 1):
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(estimated_tokens)
+
+            response = None
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = OpenAIAPIError(f"{method} {path} failed: {e}")
+            else:
+                if response.status_code < 400:
+                    return response
+                try:
+                    response_json = response.json()
+                except ValueError:
+                    response_json = None
+                last_error = OpenAIAPIError(
+                    f"{method} {path} returned {response.status_code}: {response_json or response.text[:500]}",
+                    status_code=response.status_code,
+                    response_json=response_json
+                )
+                if response.status_code not in RETRY_STATUS_CODES:
+                    raise last_error
+
+            if attempt < max_retries:
+                wait = _retry_after_seconds(response, attempt)
+                logger.warning(f"{last_error} - retrying in {wait:.1f}s ({attempt + 1}/{max_retries})")
+                time.sleep(wait)
+
+        raise last_error
+
+    def chat_completion(self, payload, timeout=None):
+        estimated_tokens = estimate_payload_tokens(payload)
+        response = self.request("POST", "chat/completions", estimated_tokens=estimated_tokens, timeout=timeout, json=payload)
+        response_json = response.json()
+
+        usage = response_json.get("usage")
+        if usage and "total_tokens" in usage:
+            self.token_bucket.adjust(usage["total_tokens"] - estimated_tokens)
+            self.record_usage(payload.get("model", ""), usage)
+
+        if not response_json.get("choices"):
+            raise OpenAIAPIError(f"No choices in API response: {response_json}", response_json=response_json)
+        return response_json
+
+    # Function to stream a chat completion, yields the content deltas as they arrive.
+    # Closing the generator closes the connection, which stops the generation.
+    def chat_completion_stream(self, payload, timeout=None):
+        payload = dict(payload, stream=True, stream_options={"include_usage": True})
+        estimated_tokens = estimate_payload_tokens(payload)
+        response = self.request("POST", "chat/completions", estimated_tokens=estimated_tokens, timeout=timeout,
+                                json=payload, stream=True)
+        try:
+            # Server-sent events, one "data: {chunk}" line per event
+            for line in response.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = json.loads(data)
+
+                usage = chunk.get("usage")
+                if usage and "total_tokens" in usage:
+                    self.token_bucket.adjust(usage["total_tokens"] - estimated_tokens)
+                    self.record_usage(payload.get("model", ""), usage)
+
+                for choice in chunk.get("choices") or []:
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        yield content
+        except requests.RequestException as e:
+            raise OpenAIAPIError(f"Streaming chat/completions failed: {e}")
+        finally:
+            response.close()
+
+    def record_usage(self, model, usage):
+        with self._usage_lock:
+            totals = self.usage.setdefault(model, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0})
+            totals["requests"] += 1
+            totals["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            # Prompt tokens served from the API prompt cache
+            totals["cached_tokens"] += (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+            totals["completion_tokens"] += usage.get("completion_tokens", 0)
+
+    # Function to summarize the usage of this process, one line per model with its cost
+    def usage_summary(self):
+        with self._usage_lock:
+            usage = {model: dict(totals) for model, totals in self.usage.items()}
+        lines = []
+        for model, totals in usage.items():
+            cost = estimate_cost(model, totals["prompt_tokens"], totals["completion_tokens"], cached_tokens=totals["cached_tokens"])
+            cache_hit = totals["cached_tokens"] * 100 / max(totals["prompt_tokens"], 1)
+            lines.append(f"{model}: {totals['requests']} requests, {totals['prompt_tokens']} prompt tokens "
+                         f"({totals['cached_tokens']} cached, {cache_hit:.0f}%), "
+                         f"{totals['completion_tokens']} completion tokens" + (f", ${cost:.2f}" if cost is not None else ""))
+        return lines
+
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+
+# Function to get the process-wide OpenAI client (created on first use)
+def get_openai_client():
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            _openai_client = OpenAIClient()
+        return _openai_client
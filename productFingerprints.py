@@ -0,0 +1,72 @@
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+
+# Fingerprints of the inputs that feed the generation prompt (title, materials, sizes,
+# producer, selected image URLs and prompt version) and of what produces the captions and the
+# description (caption model and prompt version, generation model), stored for every product after
+# its description is written. In incremental mode products whose fingerprint did not change are skipped.
+
+
+# Function to compute the fingerprint of a product's prompt inputs
+def product_fingerprint(product_info, images, prompt_version=None, caption_model=None, caption_prompt_version=None,
+                        generation_model=None):
+    inputs = {
+        "product_name": product_info.get("product_name"),
+        "materials": product_info.get("materials"),
+        "sizes": product_info.get("sizes"),
+        "producent": product_info.get("producent"),
+        "images": [image.get("url") for image in images or []],
+        "prompt_version": prompt_version,
+        # Captions are part of the prompt, a new caption model or prompt changes them
+        "caption_model": caption_model,
+        "caption_prompt_version": caption_prompt_version,
+        "generation_model": generation_model,
+    }
+    serialized = json.dumps(inputs, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class FingerprintStore:
+    def __init__(self, path, incremental=False):
+        self.path = path
+        # Only in incremental mode unchanged products are reported as such
+        self.incremental = incremental
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                product_id INTEGER PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._connection.commit()
+
+    def get_many(self, product_ids):
+        product_ids = list(product_ids)
+        stored = {}
+        with self._lock:
+            # SQLite limits the number of host parameters, query in chunks
+            for start in range(0, len(product_ids), 500):
+                chunk = product_ids[start:start + 500]
+                placeholders = ", ".join(["?"] * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT product_id, fingerprint FROM fingerprints WHERE product_id IN ({placeholders})", chunk
+                ).fetchall()
+                stored.update(rows)
+        return stored
+
+    def set(self, product_id, fingerprint):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO fingerprints (product_id, fingerprint, updated_at) VALUES (?, ?, ?)",
+                (product_id, fingerprint, time.time())
+            )
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
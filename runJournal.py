@@ -0,0 +1,131 @@
+import json
+import sqlite3
+import threading
+import time
+
+# Checkpoint journal of a bulk v1.4 run. Every product goes through the stages
+# fetched -> captioned -> generated -> written, and the artifacts of each stage
+# (product info, captioned images, assistant response) are stored with it, so a
+# restarted run skips finished products and continues the others where they stopped.
+# Submitted Batch API batches are stored too, a restarted run waits for them again
+# instead of submitting the same requests twice.
+STAGES = ["fetched", "captioned", "generated", "written"]
+
+# Final statuses that are not retried when the run is restarted
+DONE_STATUSES = {"written", "unchanged", "not_found", "no_images", "duplicate_product"}
+
+# Statuses caused by a bad assistant response, the product is generated again on restart
+REGENERATE_STATUSES = {"invalid_json", "invalid_description", "no_description_parts", "empty_response"}
+
+
+class RunJournal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Stages are recorded from pipeline worker threads, access is serialized by the lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS products (
+                ean TEXT PRIMARY KEY,
+                stage TEXT,
+                status TEXT,
+                error TEXT,
+                artifacts TEXT NOT NULL DEFAULT '{}',
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                name TEXT NOT NULL,
+                part INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                input_file_id TEXT NOT NULL,
+                batch_id TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (name, part)
+            )
+        """)
+        self._connection.commit()
+
+    def get(self, ean):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT stage, status, error, artifacts FROM products WHERE ean = ?", (ean,)
+            ).fetchone()
+        if row is None:
+            return None
+        entry = json.loads(row[3])
+        entry.update({"stage": row[0], "status": row[1], "error": row[2]})
+        return entry
+
+    def is_done(self, ean):
+        entry = self.get(ean)
+        return entry is not None and entry["status"] in DONE_STATUSES
+
+    # Function to mark a stage as finished and merge its artifacts into the entry
+    def record(self, ean, stage, **artifacts):
+        with self._lock:
+            row = self._connection.execute("SELECT artifacts FROM products WHERE ean = ?", (ean,)).fetchone()
+            stored = json.loads(row[0]) if row else {}
+            stored.update(artifacts)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO products (ean, stage, status, error, artifacts, updated_at) VALUES (?, ?, NULL, NULL, ?, ?)",
+                (ean, stage, json.dumps(stored, ensure_ascii=False, default=str), time.time())
+            )
+            self._connection.commit()
+
+    # Function to store the final status of a product for this run
+    def finish(self, ean, status, error=None):
+        with self._lock:
+            row = self._connection.execute("SELECT stage, artifacts FROM products WHERE ean = ?", (ean,)).fetchone()
+            stage, artifacts = row if row else (None, "{}")
+
+            if status in REGENERATE_STATUSES and stage == "generated":
+                # Keep the captions but drop the response that could not be used
+                stored = json.loads(artifacts)
+                stored.pop("assistant_response", None)
+                stage, artifacts = "captioned", json.dumps(stored, ensure_ascii=False, default=str)
+            elif status == "written":
+                stage = "written"
+
+            self._connection.execute(
+                "INSERT OR REPLACE INTO products (ean, stage, status, error, artifacts, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (ean, stage, status, error, artifacts, time.time())
+            )
+            self._connection.commit()
+
+    # Function to store a submitted batch, digest identifies the requests it was created from
+    def record_batch(self, name, part, digest, input_file_id, batch_id):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO batches (name, part, digest, input_file_id, batch_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (name, part, digest, input_file_id, batch_id, time.time())
+            )
+            self._connection.commit()
+
+    def get_batch(self, name, part):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT digest, input_file_id, batch_id FROM batches WHERE name = ? AND part = ?", (name, part)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"digest": row[0], "input_file_id": row[1], "batch_id": row[2]}
+
+    # Function to forget the batches of a name once their results are processed
+    def clear_batches(self, name):
+        with self._lock:
+            self._connection.execute("DELETE FROM batches WHERE name = ?", (name,))
+            self._connection.commit()
+
+    def summary(self):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT COALESCE(status, stage, 'pending'), COUNT(*) FROM products GROUP BY 1"
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
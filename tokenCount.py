@@ -0,0 +1,167 @@
+import os
+import json
+import argparse
+import functools
+from dotenv import load_dotenv
+
+try:
+    import tiktoken
+except ImportError:  # Optional, without it tokens are estimated from the text length
+    tiktoken = None
+
+load_dotenv()  # Settings below can be overridden in .env
+
+# Local token accounting for chat payloads and fine-tuning datasets, used to size runs and
+# project their cost before anything is sent. Counts are exact with tiktoken installed,
+# otherwise about 4 characters per token.
+CHARS_PER_TOKEN = 4
+FINE_TUNE_EPOCHS = int(os.getenv('FINE_TUNE_EPOCHS', 3))
+
+# Chat format overhead per message and for priming the reply (OpenAI cookbook numbers)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# USD per 1M tokens (input, output, training), check https://openai.com/api/pricing after model changes
+MODEL_PRICES = {
+    "gpt-4o-2024-08-06": (2.50, 10.00, 25.00),
+    "gpt-4o": (2.50, 10.00, 25.00),
+    "gpt-4o-mini": (0.15, 0.60, 3.00),
+    "ft:gpt-4o-2024-08-06": (3.75, 15.00, 25.00),
+    "ft:gpt-4o-mini-2024-07-18": (0.30, 1.20, 3.00),
+}
+BATCH_API_DISCOUNT = 0.5
+CACHED_INPUT_DISCOUNT = 0.5  # prompt tokens served from the API prompt cache
+
+
+# Function to get the tokenizer of a model, None without tiktoken
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(base_model(model))
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")  # gpt-4o family
+
+
+# Function to get the model a fine-tuned model was trained from ("ft:gpt-4o-2024-08-06:org::id" -> "gpt-4o-2024-08-06")
+def base_model(model):
+    return model.split(":")[1] if model.startswith("ft:") else model
+
+
+def count_text_tokens(text, model="gpt-4o-2024-08-06"):
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+# Function to count the prompt tokens of chat messages, including the chat format overhead
+def count_message_tokens(messages, model="gpt-4o-2024-08-06"):
+    tokens = TOKENS_PER_REPLY
+    for message in messages:
+        tokens += TOKENS_PER_MESSAGE
+        content = message.get("content")
+        if isinstance(content, list):
+            # Vision style content, only the text parts are counted
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        tokens += count_text_tokens(str(content or ""), model)
+        if message.get("name"):
+            tokens += 1
+    return tokens
+
+
+# Function to estimate a chat completion payload: (prompt tokens, max completion tokens)
+def count_payload_tokens(payload):
+    model = payload.get("model", "gpt-4o-2024-08-06")
+    return count_message_tokens(payload.get("messages", []), model), payload.get("max_tokens", 0)
+
+
+# Function to get the prices of a model, fine-tuned models use the prices of their base model family
+def model_prices(model):
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    if model.startswith("ft:") and f"ft:{base_model(model)}" in MODEL_PRICES:
+        return MODEL_PRICES[f"ft:{base_model(model)}"]
+    return MODEL_PRICES.get(base_model(model))
+
+
+# Function to compute the cost in USD of the given tokens, None for a model without known prices
+def estimate_cost(model, prompt_tokens, completion_tokens=0, batch_api=False, cached_tokens=0):
+    prices = model_prices(model)
+    if prices is None:
+        return None
+    input_tokens = prompt_tokens - cached_tokens * (1 - CACHED_INPUT_DISCOUNT)
+    cost = (input_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000
+    return cost * BATCH_API_DISCOUNT if batch_api else cost
+
+
+# Function to project tokens and cost of many chat payloads, completion tokens are counted at max_tokens (upper bound)
+def estimate_payloads(payloads, batch_api=False):
+    totals = {"requests": 0, "prompt_tokens": 0, "max_completion_tokens": 0, "cost": 0.0}
+    for payload in payloads:
+        prompt_tokens, completion_tokens = count_payload_tokens(payload)
+        totals["requests"] += 1
+        totals["prompt_tokens"] += prompt_tokens
+        totals["max_completion_tokens"] += completion_tokens
+        cost = estimate_cost(payload.get("model", ""), prompt_tokens, completion_tokens, batch_api)
+        if cost is not None:
+            totals["cost"] += cost
+    return totals
+
+
+def format_estimate(totals):
+    return (f"{totals['requests']} requests, {totals['prompt_tokens']} prompt tokens, "
+            f"up to {totals['max_completion_tokens']} completion tokens, up to ${totals['cost']:.2f}")
+
+
+# Function to count the tokens of a chat fine-tuning dataset and project the training cost
+def estimate_dataset(file_path, model="gpt-4o-2024-08-06", epochs=FINE_TUNE_EPOCHS):
+    stats = {"examples": 0, "tokens": 0, "max_example_tokens": 0, "system_tokens": 0, "assistant_tokens": 0}
+    with open(file_path, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            messages = json.loads(line).get("messages", [])
+            example_tokens = count_message_tokens(messages, model)
+            stats["examples"] += 1
+            stats["tokens"] += example_tokens
+            stats["max_example_tokens"] = max(stats["max_example_tokens"], example_tokens)
+            for message in messages:
+                if message["role"] in ("system", "assistant"):
+                    stats[f"{message['role']}_tokens"] += count_text_tokens(str(message.get("content") or ""), model)
+
+    prices = model_prices(model)
+    stats["epochs"] = epochs
+    stats["training_tokens"] = stats["tokens"] * epochs
+    stats["training_cost"] = stats["training_tokens"] * prices[2] / 1_000_000 if prices else None
+    return stats
+
+
+def print_dataset_estimate(file_path, model="gpt-4o-2024-08-06", epochs=FINE_TUNE_EPOCHS):
+    stats = estimate_dataset(file_path, model, epochs)
+    examples = stats["examples"] or 1
+    print(f"{file_path}: {stats['examples']} examples, {stats['tokens']} tokens "
+          f"(avg {stats['tokens'] // examples}, max {stats['max_example_tokens']} per example)")
+    print(f"  system prompt: {stats['system_tokens']} tokens ({stats['system_tokens'] * 100 // max(stats['tokens'], 1)}% of the dataset)")
+    print(f"  assistant answers: {stats['assistant_tokens']} tokens")
+    if stats["training_cost"] is not None:
+        print(f"  training {model}, {epochs} epochs: {stats['training_tokens']} tokens, about ${stats['training_cost']:.2f}")
+    if tiktoken is None:
+        print("  (tiktoken is not installed, token counts are estimated from text length)")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count tokens and project the fine-tuning cost of a chat dataset.")
+    parser.add_argument("dataset", help="Fine-tuning JSONL file")
+    parser.add_argument("--model", default="gpt-4o-2024-08-06", help="Model to fine-tune")
+    parser.add_argument("--epochs", type=int, default=FINE_TUNE_EPOCHS, help="Number of training epochs")
+    args = parser.parse_args(argv)
+    print_dataset_estimate(args.dataset, args.model, args.epochs)
+
+
+if __name__ == "__main__":
+    main()
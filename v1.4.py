@@ -1,15 +1,28 @@
 import mysql.connector
+from mysql.connector import pooling
 import json
 import os
-import requests
 from dotenv import load_dotenv
+from captionCache import get_caption_cache
+from openaiClient import get_openai_client, OpenAIAPIError
+from batchApi import build_batch_request, run_batch, chat_completion_content
+from runJournal import RunJournal
+from productFingerprints import FingerprintStore, product_fingerprint
+from tokenCount import count_payload_tokens, estimate_cost, estimate_payloads, format_estimate
+from descriptionStream import DescriptionPartsParser, DescriptionStreamError
+from descriptionSchema import IMG_ID_REGEX, DescriptionValidationError, description_response_format, validate_description
+from prompts import PROMPT_MODES, CAPTION_PROMPT_VERSION, caption_prompt, system_prompt, prompt_version
 import logging
 import random
 import re
+import sys
+import argparse
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# Load the API key from the .env file
 load_dotenv()  # Load environment variables from .env file
-api_key = os.getenv("OPENAI_API_KEY")
 
 # Database connection details
 DB_CONFIG = {
@@ -19,6 +32,50 @@ DB_CONFIG = {
     'database': os.getenv('DB_NAME')
 }
 
+# Connection pool settings (one pool shared by all DB helpers)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 4))  # mysql-connector allows at most 32
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))  # seconds to wait for a free connection
+DB_POOL_PING = os.getenv('DB_POOL_PING', '1') == '1'  # check connection health on every checkout
+
+# Maximum number of images captioned at the same time
+CAPTION_CONCURRENCY = int(os.getenv('CAPTION_CONCURRENCY', 3))
+
+# Number of EANs loaded with a single query in batch runs
+PRODUCT_CHUNK_SIZE = int(os.getenv('PRODUCT_CHUNK_SIZE', 200))
+
+# Async pipeline settings: size of the queues between stages and number of workers per stage
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 8))
+PIPELINE_STAGE_WORKERS = {
+    "caption": int(os.getenv('PIPELINE_CAPTION_WORKERS', 2)),
+    "generate": int(os.getenv('PIPELINE_GENERATE_WORKERS', 4)),
+    "write": int(os.getenv('PIPELINE_WRITE_WORKERS', 2)),
+}
+
+# Vision model used for captions (caption prompt and its version are in prompts.py)
+CAPTION_MODEL = "gpt-4o-2024-08-06"
+
+# Fine-tuned model used for description generation
+GENERATION_MODEL = "ft:gpt-4o-2024-08-06:personal::A8nS4dK3"
+
+# Generation prompt: "full" is the format the model was fine-tuned on, "compact" drops unknown
+# fields, uses short keys and a condensed system prompt (compare both with --compare-prompts)
+PROMPT_MODE = os.getenv('PROMPT_MODE', 'full')
+# Requests of one prompt version share a prompt_cache_key, which helps the API route them to its cached prefix
+PROMPT_CACHE_KEY = os.getenv('PROMPT_CACHE_KEY', '1') == '1'
+
+# Constrain generation to the description JSON schema (structured outputs, supported by gpt-4o-2024-08-06 fine-tunes)
+STRUCTURED_OUTPUT = os.getenv('STRUCTURED_OUTPUT', '1') == '1'
+
+# Stream generation responses and check every description part as it arrives (aborting broken ones)
+STREAM_GENERATION = os.getenv('STREAM_GENERATION', '0') == '1'
+
+# Value the database helpers use for missing product data
+MISSING_VALUE = "brak informacji"
+
+# Per-call (connect, read) timeouts in seconds
+CAPTION_TIMEOUT = (10, 60)
+GENERATION_TIMEOUT = (10, 180)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -31,49 +88,101 @@ def log_sql(query, params=None):
         logger.info(f"Executing SQL: {query}")
 
 
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+# Function to get a connection from the shared pool, close() returns it to the pool
+def get_db_connection():
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = pooling.MySQLConnectionPool(
+                pool_name="v14_pool",
+                pool_size=DB_POOL_SIZE,
+                pool_reset_session=True,
+                **DB_CONFIG
+            )
+            logger.info(f"Created MySQL connection pool of size {DB_POOL_SIZE}")
+
+    # The pool raises immediately when exhausted, so wait for a connection to be returned
+    deadline = time.monotonic() + DB_POOL_TIMEOUT
+    while True:
+        try:
+            connection = _connection_pool.get_connection()
+            break
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+    if DB_POOL_PING:
+        # Warm connections can be dropped by the server (wait_timeout), reconnect them transparently
+        try:
+            connection.ping(reconnect=True, attempts=3, delay=1)
+        except mysql.connector.Error:
+            connection.close()
+            raise
+
+    return connection
+
+
+# Columns of cms_art_produkty used to build product_info
+PRODUCT_COLUMNS = """
+    CA_CW_ID, CA_TYTUL, ca_filters_material1, ca_filters_material2, ca_filters_material3, ca_filters_wysokosc, ca_filters_dlugosc, ca_filters_szerokosc, ca_filters_glebokosc, ca_filters_srednica, ca_filters_pojemnosc, CA_PRODUCENT_ID
+"""
+
+
+# Function to build the product_info dictionary from a cms_art_produkty row and producer name
+def product_info_from_row(product, producent_name):
+    return {
+        "product_id": product[0],
+        "product_name": product[1],
+        "materials": {
+            "material1": product[2] if product[2] else "brak informacji",
+            "material2": product[3] if product[3] else "brak informacji",
+            "material3": product[4] if product[4] else "brak informacji"
+        },
+        "sizes": {
+            "wysokość": product[5] if product[5] else "brak informacji",
+            "długość": product[6] if product[6] else "brak informacji",
+            "szerokość": product[7] if product[7] else "brak informacji",
+            "głębokość": product[8] if product[8] else "brak informacji",
+            "średnica": product[9] if product[9] else "brak informacji",
+            "pojemność": product[10] if product[10] else "brak informacji",
+        },
+        "producent": producent_name if producent_name else "brak informacji"
+    }
+
+
 # Function to get product information, including materials
 def get_product_info_with_ean(product_ean):
-    connection = mysql.connector.connect(**DB_CONFIG)
+    connection = get_db_connection()
     cursor = connection.cursor()
 
     query = f"""
-    SELECT CA_CW_ID, CA_TYTUL, ca_filters_material1, ca_filters_material2, ca_filters_material3, ca_filters_wysokosc, ca_filters_dlugosc, ca_filters_szerokosc, ca_filters_glebokosc, ca_filters_srednica, ca_filters_pojemnosc, CA_PRODUCENT_ID
+    SELECT {PRODUCT_COLUMNS}
     FROM cms_art_produkty
     WHERE CA_EAN = '{product_ean}'
     """
     cursor.execute(query)
     product = cursor.fetchone()
 
-    query = f"""
-    SELECT CP_NAZWA
-    FROM cms_producenci
-    WHERE CP_ID = '{product[11]}'
-    """
-    cursor.execute(query)
-    producent = cursor.fetchone()
+    producent = None
+    if product:
+        query = f"""
+        SELECT CP_NAZWA
+        FROM cms_producenci
+        WHERE CP_ID = '{product[11]}'
+        """
+        cursor.execute(query)
+        producent = cursor.fetchone()
 
     cursor.close()
     connection.close()
 
     if product:
-        product_info = {
-            "product_id": product[0],
-            "product_name": product[1],
-            "materials": {
-                "material1": product[2] if product[2] else "brak informacji",
-                "material2": product[3] if product[3] else "brak informacji",
-                "material3": product[4] if product[4] else "brak informacji"
-            },
-            "sizes": {
-                "wysokość": product[5] if product[5] else "brak informacji",
-                "długość": product[6] if product[6] else "brak informacji",
-                "szerokość": product[7] if product[7] else "brak informacji",
-                "głębokość": product[8] if product[8] else "brak informacji",
-                "średnica": product[9] if product[9] else "brak informacji",
-                "pojemność": product[10] if product[10] else "brak informacji",
-            },
-            "producent": producent[0]
-        }
+        product_info = product_info_from_row(product, producent[0] if producent else None)
         logger.info(f"Product Info: {product_info}")
         return product_info
     else:
@@ -81,13 +190,54 @@ def get_product_info_with_ean(product_ean):
         return None
 
 
+# Function to split a list into chunks of at most `size` items
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+# Function to get product information for many EANs at once, producer name is joined in SQL.
+# Returns {ean: product_info}, EANs without a product are missing from the result.
+def get_products_info_with_eans(product_eans, chunk_size=None):
+    chunk_size = chunk_size or PRODUCT_CHUNK_SIZE
+    products_info = {}
+    if not product_eans:
+        return products_info
+
+    connection = get_db_connection()
+    cursor = connection.cursor()
+
+    for chunk in chunked(list(product_eans), chunk_size):
+        placeholders = ", ".join(["%s"] * len(chunk))
+        query = f"""
+        SELECT CA_EAN, {PRODUCT_COLUMNS}, CP_NAZWA
+        FROM cms_art_produkty
+        LEFT JOIN cms_producenci ON CP_ID = CA_PRODUCENT_ID
+        WHERE CA_EAN IN ({placeholders})
+        ORDER BY CA_CW_ID ASC
+        """
+        log_sql(query, f"{len(chunk)} EANs")
+        cursor.execute(query, tuple(chunk))
+
+        for row in cursor.fetchall():
+            # Like the single-EAN query, the first product wins when an EAN is not unique
+            if row[0] not in products_info:
+                products_info[row[0]] = product_info_from_row(row[1:13], row[13])
+
+    cursor.close()
+    connection.close()
+
+    logger.info(f"Loaded {len(products_info)} of {len(product_eans)} products")
+    return products_info
+
+
 # Function to get all image URLs for a product
 def get_product_images(product_id):
-    connection = mysql.connector.connect(**DB_CONFIG)
+    connection = get_db_connection()
     cursor = connection.cursor()
 
     query = f"""
-    SELECT CZ_CZS_ID, CZ_SOURCE_SRC, CZ_KOLEJNOSC, CZ_TYP
+    SELECT CZ_CZS_ID, CZ_SOURCE_SRC, CZ_KOLEJNOSC, CZ_TYP, CZ_SRC, CZ_WIDTH, CZ_HEIGHT
     FROM (
         SELECT
             CZ_CZS_ID,
@@ -98,6 +248,9 @@ def get_product_images(product_id):
             END AS CZ_SOURCE_SRC, 
             CZ_KOLEJNOSC, 
             CZ_TYP,
+            CZ_SRC,
+            CZ_WIDTH,
+            CZ_HEIGHT,
             ROW_NUMBER() OVER (
                 PARTITION BY CZ_KOLEJNOSC
                 ORDER BY 
@@ -109,7 +262,7 @@ def get_product_images(product_id):
                     END
             ) AS rn
         FROM cms_zalaczniki
-        WHERE CZ_CW_ID = {product_id} AND CZ_CZS_ID = 0 OR CZ_CZS_ID IS NULL
+        WHERE CZ_CW_ID = {product_id} AND (CZ_CZS_ID = 0 OR CZ_CZS_ID IS NULL)
     ) AS OrderedImages
     WHERE rn = 1
     ORDER BY CZ_KOLEJNOSC ASC
@@ -120,7 +273,8 @@ def get_product_images(product_id):
     images = []
     for idx, row in enumerate(cursor.fetchall()):
         url = row[1] if row[1] != 0 else None  # Handle 0 as None or invalid URL
-        images.append({"img_id": idx + 1, "url": url})
+        # CZ_SRC and its dimensions are kept for the width/height attributes in CA_TRESC
+        images.append({"img_id": idx + 1, "url": url, "src": row[4], "width": row[5], "height": row[6]})
 
     logger.info(f"Fetched images: {images}")
     cursor.close()
@@ -129,19 +283,81 @@ def get_product_images(product_id):
     return images
 
 
+# Function to get the first 3 images of many products with one windowed query per chunk.
+# Returns {product_id: images} with the same image dicts as get_product_images().
+def get_products_images(product_ids, chunk_size=None):
+    chunk_size = chunk_size or PRODUCT_CHUNK_SIZE
+    products_images = {product_id: [] for product_id in product_ids}
+    if not product_ids:
+        return products_images
 
-# Function to send an image URL to GPT-4 API and get a description
-def send_image_url_to_gpt(image_url):
-    #return "Here is description"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+    connection = get_db_connection()
+    cursor = connection.cursor()
 
-    prompt = f"Opis zdjęcia produktu dla sklepu internetowego. Krótko opisz to co jest na zdjęciu.\nZdjęcie: {image_url}"
+    for chunk in chunked(list(product_ids), chunk_size):
+        placeholders = ", ".join(["%s"] * len(chunk))
+        # rn picks the best image type for every position, img_rank keeps the first 3 positions of each product
+        query = f"""
+        SELECT CZ_CW_ID, CZ_SOURCE_SRC, CZ_KOLEJNOSC, CZ_SRC, CZ_WIDTH, CZ_HEIGHT
+        FROM (
+            SELECT
+                CZ_CW_ID,
+                CZ_SOURCE_SRC,
+                CZ_KOLEJNOSC,
+                CZ_SRC,
+                CZ_WIDTH,
+                CZ_HEIGHT,
+                ROW_NUMBER() OVER (PARTITION BY CZ_CW_ID ORDER BY CZ_KOLEJNOSC ASC) AS img_rank
+            FROM (
+                SELECT
+                    CZ_CW_ID,
+                    CASE
+                        WHEN CZ_SOURCE_SRC IS NOT NULL AND CZ_SOURCE_SRC != ''
+                        THEN CONCAT('https://www.superwnetrze.pl/i/cms/originals/', CZ_SOURCE_SRC)
+                        ELSE CZ_SRC
+                    END AS CZ_SOURCE_SRC,
+                    CZ_KOLEJNOSC,
+                    CZ_SRC,
+                    CZ_WIDTH,
+                    CZ_HEIGHT,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY CZ_CW_ID, CZ_KOLEJNOSC
+                        ORDER BY
+                            CASE
+                                WHEN CZ_TYP = 'D' THEN 1
+                                WHEN CZ_TYP = 'S' THEN 2
+                                WHEN CZ_TYP = 'M' THEN 3
+                                ELSE 4
+                            END
+                    ) AS rn
+                FROM cms_zalaczniki
+                WHERE CZ_CW_ID IN ({placeholders}) AND (CZ_CZS_ID = 0 OR CZ_CZS_ID IS NULL)
+            ) AS OrderedImages
+            WHERE rn = 1
+        ) AS RankedImages
+        WHERE img_rank <= 3
+        ORDER BY CZ_CW_ID ASC, CZ_KOLEJNOSC ASC
+        """
+        log_sql(query, f"{len(chunk)} products")
+        cursor.execute(query, tuple(chunk))
 
-    payload = {
-        "model": "gpt-4o-2024-08-06",  # Use GPT-4 or your fine-tuned model
+        for row in cursor.fetchall():
+            images = products_images.setdefault(row[0], [])
+            url = row[1] if row[1] != 0 else None  # Handle 0 as None or invalid URL
+            images.append({"img_id": len(images) + 1, "url": url, "src": row[3], "width": row[4], "height": row[5]})
+
+    cursor.close()
+    connection.close()
+
+    return products_images
+
+
+# Function to build the caption request body, shared by direct calls and the Batch API
+def build_caption_payload(image_url):
+    prompt = caption_prompt(image_url)
+
+    return {
+        "model": CAPTION_MODEL,  # Use GPT-4 or your fine-tuned model
         "messages": [
             {
                 "role": "user",
@@ -151,121 +367,200 @@ def send_image_url_to_gpt(image_url):
         "max_tokens": 150  # Limit to 150 tokens for the description
     }
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    response_json = response.json()
 
-    if 'choices' in response_json:
-        return response_json['choices'][0]['message']['content']
-    else:
-        print(f"Error in API call: {response_json}")
-        return "Description not available"
-
-
-# Function to process images and add their descriptions
+# Function to send an image URL to GPT-4 API and get a description
+def send_image_url_to_gpt(image_url):
+    #return "Here is description"
+    cache = get_caption_cache()
+    cached_description = cache.get(image_url, CAPTION_MODEL, CAPTION_PROMPT_VERSION)
+    if cached_description is not None:
+        logger.info(f"Using cached description for {image_url}")
+        return cached_description
+
+    payload = build_caption_payload(image_url)
+
+    # Rate limits, retries and backoff are handled by the shared client, errors are raised
+    response_json = get_openai_client().chat_completion(payload, timeout=CAPTION_TIMEOUT)
+    description = response_json['choices'][0]['message']['content']
+    cache.set(image_url, CAPTION_MODEL, CAPTION_PROMPT_VERSION, description)
+    return description
+
+
+# Function to add a description to a single image
+def describe_image(image):
+    try:
+        description = send_image_url_to_gpt(image['url'])
+        image['description'] = description  # Add description to the existing dictionary
+    except OpenAIAPIError:
+        # Retries are exhausted, fail the product instead of generating from a missing caption
+        raise
+    except Exception as e:
+        logger.error(f"Error processing {image['url']}: {e}")
+        image['description'] = "Description not available"
+    return image
+
+
+# Function to process images and add their descriptions, images are captioned concurrently
 def process_images_with_descriptions(image_urls):
-    descriptions = []
-    for image in image_urls:
-        try:
-            description = send_image_url_to_gpt(image['url'])
-            image['description'] = description  # Add description to the existing dictionary
-        except Exception as e:
-            print(f"Error processing {image['url']}: {e}")
-            image['description'] = "Description not available"
+    if len(image_urls) <= 1 or CAPTION_CONCURRENCY <= 1:
+        for image in image_urls:
+            describe_image(image)
+        return image_urls
 
-    return image_urls  # Return the updated list with descriptions
+    # Each image dict is updated in place, so the list keeps its img_id order
+    with ThreadPoolExecutor(max_workers=min(CAPTION_CONCURRENCY, len(image_urls))) as executor:
+        list(executor.map(describe_image, image_urls))
 
-# Function to send chat_data to GPT-4 API and get the assistant's completion
-def send_chat_data_to_gpt(chat_data):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+    return image_urls  # Return the updated list with descriptions
 
+# Function to build the generation request body, shared by direct calls and the Batch API
+def build_generation_payload(chat_data, prompt_mode=None):
     payload = {
-        "model": "ft:gpt-4o-2024-08-06:personal::A8nS4dK3",  # Use GPT-4 or your fine-tuned model
+        "model": GENERATION_MODEL,  # Use GPT-4 or your fine-tuned model
         "messages": chat_data["messages"],
         "max_tokens": 1200,  # Adjust as needed
     }
+    if STRUCTURED_OUTPUT:
+        payload["response_format"] = description_response_format()
+    if PROMPT_CACHE_KEY:
+        payload["prompt_cache_key"] = f"v1.4-{prompt_version(prompt_mode or PROMPT_MODE)}"
+    return payload
+
+
+# Representative product for run projections: all fields known and 3 captioned images
+PROJECTION_PRODUCT = {
+    "product_id": 0,
+    "product_name": "Wazon ceramiczny ręcznie malowany z motywem roślinnym 30 cm",
+    "materials": {"material1": "ceramika", "material2": "szkliwo", "material3": MISSING_VALUE},
+    "sizes": {"wysokość": "30 cm", "długość": MISSING_VALUE, "szerokość": MISSING_VALUE,
+              "głębokość": MISSING_VALUE, "średnica": "15 cm", "pojemność": "2 l"},
+    "producent": "Przykładowy Producent"
+}
+PROJECTION_CAPTION = ("Na zdjęciu widać ceramiczny wazon w kolorze kremowym z ręcznie malowanym motywem roślinnym "
+                      "w odcieniach zieleni i błękitu. Wazon stoi na drewnianym stole obok książek, w tle jasna ściana "
+                      "i dzienne światło, które podkreśla błyszczące szkliwo i fakturę powierzchni.")
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    response_json = response.json()
 
-    if 'choices' in response_json:
-        return response_json['choices'][0]['message']['content']
-    else:
-        print(f"Error in API call: {response_json}")
-        return "Error in API call"
+# Function to log the projected tokens and cost of generating descriptions for product_count products,
+# completion tokens are counted at max_tokens (upper bound)
+def log_run_projection(product_count):
+    images = [{"img_id": img_id, "url": None, "description": PROJECTION_CAPTION} for img_id in (1, 2, 3)]
+    payload = build_generation_payload(build_chat_data(PROJECTION_PRODUCT, images))
+    # Every request is about the same size, so one payload is counted and scaled
+    totals = {key: value * product_count for key, value in estimate_payloads([payload]).items()}
+    logger.info(f"Run projection ({PROMPT_MODE} prompt, captions not included): {format_estimate(totals)}")
 
 
-# Function to replace img_id with URLs in the assistant's output
-def replace_img_id_with_urls(text, image_id_to_url):
-    for image in image_id_to_url:
-        img_id = f"img_id:{image['img_id']}"
+# Function to send chat_data to GPT-4 API and get the assistant's completion
+def send_chat_data_to_gpt(chat_data, images_with_descriptions=None):
+    payload = build_generation_payload(chat_data)
+    prompt_tokens, max_completion_tokens = count_payload_tokens(payload)
+    cost = estimate_cost(payload["model"], prompt_tokens, max_completion_tokens)
+    logger.info(f"Generation request: {prompt_tokens} prompt tokens, up to {max_completion_tokens} completion tokens"
+                + (f", up to ${cost:.4f}" if cost is not None else ""))
+
+    if STREAM_GENERATION:
+        return stream_chat_data_to_gpt(payload, images_with_descriptions)
+
+    # Raises OpenAIAPIError when the call still fails after retries, so nothing is written for the product
+    response_json = get_openai_client().chat_completion(payload, timeout=GENERATION_TIMEOUT)
+    usage = response_json.get("usage") or {}
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+    logger.info(f"Generation usage: {usage.get('prompt_tokens')} prompt tokens ({cached_tokens} cached), "
+                f"{usage.get('completion_tokens')} completion tokens")
+    return response_json['choices'][0]['message']['content']
+
+
+# Function to stream the completion and validate description parts as they arrive.
+# A malformed part aborts the request and raises DescriptionStreamError, so nothing is
+# written for the product and the rest of the completion is not paid for.
+def stream_chat_data_to_gpt(payload, images_with_descriptions=None):
+    known_img_ids = {image["img_id"] for image in images_with_descriptions} if images_with_descriptions else None
+    parser = DescriptionPartsParser(known_img_ids)
+    received = []
+
+    stream = get_openai_client().chat_completion_stream(payload, timeout=GENERATION_TIMEOUT)
+    try:
+        for content in stream:
+            received.append(content)
+            for part in parser.feed(content):
+                logger.info(f"Description part {part['capd_desc_order']} received")
+    except DescriptionStreamError as e:
+        logger.error(f"Aborting generation after {len(''.join(received))} characters: {e}")
+        raise
+    finally:
+        stream.close()
+
+    return "".join(received)
+
+
+# Function to build the img_id -> URL lookup of a product's images, built once per product
+def build_img_id_lookup(images):
+    lookup = {}
+    for image in images:
         if image['url']:
-            url = str(image['url'])
+            lookup[str(image['img_id'])] = str(image['url'])
         else:
-            url = "Invalid URL"
+            lookup[str(image['img_id'])] = "Invalid URL"
             logger.warning(f"Invalid URL for img_id: {image['img_id']}")
-        text = text.replace(img_id, url)
-    return text
-
-
-
-# Function to insert description parts into the database
-def description_parts_to_insert(product_id, description_parts, image_id_to_url):
-    connection = mysql.connector.connect(**DB_CONFIG)
-    cursor = connection.cursor()
-
-    # Delete existing descriptions for the product
-    delete_query = "DELETE FROM cms_art_produkty_desc WHERE capd_cw_id = %s"
-    log_sql(delete_query, product_id)
-    cursor.execute(delete_query, (product_id,))
-    connection.commit()
-
-    for part in description_parts:
-        order = part.get('capd_desc_order', 0)
-        left = replace_img_id_with_urls(part.get('capd_desc_text', ''), image_id_to_url)
-        right = replace_img_id_with_urls(part.get('capd_desc_text2', ''), image_id_to_url)
-
-        # Prepare the SQL query for inserting into cms_art_produkty_desc
-        query = """
-        INSERT INTO cms_art_produkty_desc (capd_cw_id, capd_desc_order, capd_desc_text, capd_desc_text2)
-        VALUES (%s, %s, %s, %s)
-        """
-        values = (product_id, order, left, right)
-
-        log_sql(query, values)
-        cursor.execute(query, values)
-
-    # Commit the changes to the database
-    connection.commit()
-
-    logger.info(f"Inserted description parts for product {product_id}")
-    cursor.close()
-    connection.close()
-    
-
-def update_ca_tresc(product_id):
-    connection = mysql.connector.connect(**DB_CONFIG)
-    cursor = connection.cursor()
-
-    # Fetch all description parts for the product
-    query = """
-    SELECT capd_desc_order, capd_desc_text, capd_desc_text2, capd_kind
-    FROM cms_art_produkty_desc
-    WHERE capd_cw_id = %s
-    ORDER BY capd_desc_order ASC
-    """
-    log_sql(query, product_id)
-    cursor.execute(query, (product_id,))
-    description_parts = cursor.fetchall()
+    return lookup
+
+
+# Function to replace img_id with URLs in the assistant's output, in one pass over the text.
+# image_id_to_url is the images list or a lookup from build_img_id_lookup(). Placeholders
+# without an image are left as they are and their ids are added to `unresolved`.
+def replace_img_id_with_urls(text, image_id_to_url, unresolved=None):
+    lookup = image_id_to_url if isinstance(image_id_to_url, dict) else build_img_id_lookup(image_id_to_url)
+
+    def substitute(match):
+        url = lookup.get(match.group(1))
+        if url is None:
+            if unresolved is not None:
+                unresolved.add(int(match.group(1)))
+            return match.group(0)
+        return url
+
+    return IMG_ID_REGEX.sub(substitute, text or "")
+
+
+# Function to get (width, height) for all image sources at once.
+# Images loaded with get_product_images() already carry their dimensions,
+# only sources outside of them are looked up with one query.
+def resolve_image_dimensions(cursor, img_srcs, images=None):
+    dimensions = {}
+    known_urls = set()
+    for image in images or []:
+        known_urls.add(image.get('url'))
+        if image.get('src') and image.get('width') and image['width'] > 0:
+            dimensions[image['src']] = (image['width'], image['height'])
+
+    missing = [img_src for img_src in dict.fromkeys(img_srcs) if img_src not in dimensions and img_src not in known_urls]
+    if missing:
+        placeholders = ", ".join(["%s"] * len(missing))
+        image_query = f"SELECT CZ_SRC, CZ_WIDTH, CZ_HEIGHT FROM cms_zalaczniki WHERE CZ_SRC IN ({placeholders}) AND CZ_WIDTH > 0"
+        log_sql(image_query, missing)
+        cursor.execute(image_query, tuple(missing))
+        for img_src, width, height in cursor.fetchall():
+            dimensions.setdefault(img_src, (width, height))
+
+    return dimensions
+
+
+# Function to build CA_TRESC HTML from (order, text, text2) rows sorted by order
+def render_ca_tresc(cursor, description_parts, images=None):
+    # Collect image sources of all sections first and resolve their dimensions together
+    img_srcs = []
+    for order, text, text2 in description_parts:
+        if order != -1:
+            img_srcs.extend(extract_image_sources(text) + extract_image_sources(text2))
+    image_dimensions = resolve_image_dimensions(cursor, img_srcs, images)
 
     # Initialize CA_TRESC as an empty string
     ca_tresc = ""
 
     # Iterate over each description part
     for part in description_parts:
-        order, text, text2, kind = part
+        order, text, text2 = part
 
         # Skip invalid or empty sections
         if order == -1:
@@ -277,10 +572,8 @@ def update_ca_tresc(product_id):
             if '<img' in field_content:
                 img_srcs = extract_image_sources(field_content)
                 for img_src in img_srcs:
-                    image_query = f"SELECT CZ_WIDTH, CZ_HEIGHT FROM cms_zalaczniki WHERE CZ_SRC = %s"
-                    cursor.execute(image_query, (img_src,))
-                    img = cursor.fetchone()
-                    if img and img[0] > 0:
+                    img = image_dimensions.get(img_src)
+                    if img:
                         width, height = img
                         field_content = field_content.replace(
                             f'<img src="{img_src}"',
@@ -313,6 +606,10 @@ def update_ca_tresc(product_id):
         # Append the generated HTML to CA_TRESC
         ca_tresc += section_html
 
+    return ca_tresc
+
+
+def execute_ca_tresc_update(cursor, product_id, ca_tresc):
     # Update the CA_TRESC field in cms_art_produkty
     # !!!
     # If doing a test REMOVE ca_is_multitext = 1 to not fill database with not trusted description
@@ -324,11 +621,53 @@ def update_ca_tresc(product_id):
     """
     log_sql(update_query, (ca_tresc, product_id))
     cursor.execute(update_query, (ca_tresc, product_id))
-    connection.commit()
 
-    logger.info(f"CA_TRESC field updated for product {product_id}")
-    cursor.close()
-    connection.close()
+
+# Function to replace description parts and CA_TRESC in a single transaction.
+# CA_TRESC is rendered from the parts in memory, so nothing is read back and the
+# storefront never sees a half-written description.
+def write_description(product_id, description_parts, image_id_to_url):
+    rows = []
+    img_id_lookup = build_img_id_lookup(image_id_to_url)
+    unresolved = set()
+    for part in description_parts:
+        order = part.get('capd_desc_order', 0)
+        left = replace_img_id_with_urls(part.get('capd_desc_text', ''), img_id_lookup, unresolved)
+        right = replace_img_id_with_urls(part.get('capd_desc_text2', ''), img_id_lookup, unresolved)
+        rows.append((order, left, right))
+    if unresolved:
+        logger.warning(f"Unresolved img ids for product {product_id}: {sorted(unresolved)}")
+
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    try:
+        connection.start_transaction()
+
+        delete_query = "DELETE FROM cms_art_produkty_desc WHERE capd_cw_id = %s"
+        log_sql(delete_query, product_id)
+        cursor.execute(delete_query, (product_id,))
+
+        insert_query = """
+        INSERT INTO cms_art_produkty_desc (capd_cw_id, capd_desc_order, capd_desc_text, capd_desc_text2)
+        VALUES (%s, %s, %s, %s)
+        """
+        values = [(product_id, order, left, right) for order, left, right in rows]
+        log_sql(insert_query, values)
+        cursor.executemany(insert_query, values)
+
+        # Sections are rendered in capd_desc_order, like they are shown in the shop
+        ca_tresc = render_ca_tresc(cursor, sorted(rows, key=lambda row: row[0]), image_id_to_url)
+        execute_ca_tresc_update(cursor, product_id, ca_tresc)
+
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+    logger.info(f"Description and CA_TRESC written for product {product_id}")
 
 
 
@@ -339,126 +678,787 @@ def extract_image_sources(text):
 
 
 
+# Function to build the chat messages (system prompt and product data) for a product
+def build_chat_data(product_info, images_with_descriptions, prompt_mode=None):
+    if (prompt_mode or PROMPT_MODE) == "compact":
+        return build_compact_chat_data(product_info, images_with_descriptions)
+
+    # Prepare the user message with product information, materials, and images
+    user_message = {
+        "product_id": product_info["product_id"],
+        "product_name": product_info["product_name"],
+        "producent_name": product_info["producent"],
+        "materials": product_info["materials"],
+        "sizes": product_info["sizes"],
+        "images": [
+            {
+                "img_id": image["img_id"],
+                "description": image["description"]
+            } for image in images_with_descriptions
+        ]
+    }
+
+    chat_data = {
+        "messages": [
+            {
+                "role": "system",
+                "content": system_prompt("full")
+            },
+            {
+                "role": "user",
+                "content": json.dumps(user_message, ensure_ascii=False)
+            }
+        ]
+    }
+    return chat_data
+
+
+# Function to build the compact user message: unknown fields are left out and keys are short
+def build_compact_user_message(product_info, images_with_descriptions):
+    user_message = {"n": product_info["product_name"]}
+    if product_info["producent"] and product_info["producent"] != MISSING_VALUE:
+        user_message["p"] = product_info["producent"]
+
+    materials = [value for value in product_info["materials"].values() if value and value != MISSING_VALUE]
+    if materials:
+        user_message["m"] = materials
+    sizes = {key: value for key, value in product_info["sizes"].items() if value and value != MISSING_VALUE}
+    if sizes:
+        user_message["s"] = sizes
+
+    user_message["i"] = [{"id": image["img_id"], "d": image["description"]} for image in images_with_descriptions]
+    return json.dumps(user_message, ensure_ascii=False, separators=(",", ":"))
+
+
+def build_compact_chat_data(product_info, images_with_descriptions):
+    return {
+        "messages": [
+            {
+                "role": "system",
+                "content": system_prompt("compact")
+            },
+            {
+                "role": "user",
+                "content": build_compact_user_message(product_info, images_with_descriptions)
+            }
+        ]
+    }
+
+
+# Function to parse the assistant's response and write the description into the database
+def save_assistant_response(product_id, assistant_response, images_with_descriptions):
+    if assistant_response:
+        logger.info(f"Assistant Response:\n{assistant_response}")
+
+        try:
+            # Ensure the assistant's response is valid JSON
+            response_json = json.loads(assistant_response)
+            # Unknown or repeated image ids are rejected before anything is written
+            description_parts = validate_description(response_json, images_with_descriptions)
+
+            if description_parts:
+                write_description(product_id, description_parts, images_with_descriptions)
+                logger.info(f"Product ID {product_id} updated in the database.")
+                return "written"
+            else:
+                logger.warning("No description parts found in the assistant's response.")
+                return "no_description_parts"
+        except json.JSONDecodeError as e:
+            logger.error(f"Error parsing assistant's response: {e}")
+            return "invalid_json"
+        except DescriptionValidationError as e:
+            logger.error(f"Invalid description for product ID {product_id}: {e}")
+            return "invalid_description"
+    else:
+        logger.error("Assistant's response is empty or None.")
+        return "empty_response"
+
+
 # Function to create and send system message and user input for a specific product
 def display_fine_tune_input_for_single_product(product_ean):
     product_info = get_product_info_with_ean(product_ean)
+    return process_product_info(product_ean, product_info)
+
 
+# Function to run images, captions, generation and DB write for an already loaded product.
+# With a checkpoint journal every finished stage is recorded, and a product resumed from the
+# journal (stage "captioned" or "generated") reuses the stored captions / assistant response.
+def process_product_info(product_ean, product_info, images=None, journal=None, stage=None, assistant_response=None):
     if product_info:
         product_id = product_info["product_id"]
-        producent = product_info["producent"]
-        product_name = product_info["product_name"]
-        materials = product_info["materials"]
-        sizes = product_info["sizes"]
 
-        # Get product images
-        images = get_product_images(product_id)
+        # Get product images, unless they were already loaded for the whole batch
+        if images is None:
+            images = get_product_images(product_id)
 
         if not images:
             logger.warning(f"No images found for product ID {product_id}.")
-            return
+            status = "no_images"
+        else:
+            if journal and stage is None:
+                journal.record(product_ean, "fetched", product_info=product_info, images=images)
+
+            # Process images and add descriptions
+            if stage in ("captioned", "generated"):
+                images_with_descriptions = images
+            else:
+                images_with_descriptions = process_images_with_descriptions(images)
+                if journal:
+                    journal.record(product_ean, "captioned", images=images_with_descriptions)
+
+            # Log the images with descriptions
+            logger.info(f"Images with descriptions: {images_with_descriptions}")
+
+            # Send data to GPT
+            if stage != "generated":
+                chat_data = build_chat_data(product_info, images_with_descriptions)
+                assistant_response = send_chat_data_to_gpt(chat_data, images_with_descriptions)
+                if journal:
+                    journal.record(product_ean, "generated", assistant_response=assistant_response)
+
+            status = save_assistant_response(product_id, assistant_response, images_with_descriptions)
+    else:
+        logger.warning(f"No product found for Product EAN: {product_ean}")
+        status = "not_found"
 
-        # Process images and add descriptions
-        images_with_descriptions = process_images_with_descriptions(images)
+    if journal:
+        journal.finish(product_ean, status)
+    return status
 
-        # Log the images with descriptions
-        logger.info(f"Images with descriptions: {images_with_descriptions}")
 
-        # Create the system prompt
-        system_prompt = """
-Jesteś asystentem sklepu e-commerce. Twoim zadaniem jest tworzenie atrakcyjnych opisów produktów w strukturze:
+# Function to read EANs from a file (one per line, '-' means stdin)
+def read_eans_from_file(path):
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r", encoding="utf-8") as file:
+            lines = file.read().splitlines()
 
-- **capd_cw_id**: ID produktu
-- **capd_desc_order**: kolejność części opisu
-- **capd_desct_text**: lewa strona opisu (z HTML)
-- **capd_desct_text2**: prawa strona opisu (z HTML)
+    eans = []
+    for line in lines:
+        ean = line.strip()
+        # Skip empty lines and comments
+        if ean and not ean.startswith('#'):
+            eans.append(ean)
+    return eans
 
-**Instrukcje:**
 
-1. Opracuj krótki opis produktu na podstawie podanych informacji. **Nie dodawaj niepewnych danych.**
-2. Wybierz najlepsze zdjęcia dla fragmentów opisu, aby wspierały tekst. **Rozmiar max: 600x600.**
-3. Zaplanuj, gdzie umieścić zdjęcia (lewo/prawo) dla najlepszej prezentacji.
-4. Stwórz opis używając struktury:
+# Function to get EANs of active products, optionally narrowed with an extra SQL condition
+def get_active_product_eans(sql_filter=None):
+    connection = get_db_connection()
+    cursor = connection.cursor()
 
-{
-  "description_parts": [
-    {
-      "capd_desc_order": 1,
-      "capd_desc_text": "Treść dla lewej strony z HTML",
-      "capd_desc_text2": "Treść dla prawej strony z HTML"
-    }
-    // Dodatkowe części według potrzeb
-  ]
-}
+    query = """
+    SELECT CA_EAN
+    FROM cms_art_produkty
+    WHERE CA_AKTYWNY = 'T' AND CA_EAN IS NOT NULL AND CA_EAN != ''
+    """
+    if sql_filter:
+        query += f" AND ({sql_filter})"
+    query += " ORDER BY CA_CW_ID ASC"
 
-**WAŻNE:**
+    log_sql(query)
+    cursor.execute(query)
+    eans = [row[0] for row in cursor.fetchall()]
 
-- **Pisz specyfikację tylko z dostępnych danych.**
-- Używaj **wyłącznie** podanych identyfikatorów obrazów. **Nie dodawaj ani nie generuj nowych linków; wstawiaj tylko id zdjęcia w postaci img src=\"img_id:id\
-, gdzie id to odpowiedni numer obrazu.**
-- Zachowaj odpowiednią strukturę HTML. **Nie pozostawiaj pustych pól.**
-- Zadbaj o estetykę, spójność i czytelność. Używaj symboli ✅, ⭐, ale bez przesady.
-- Jeśli jest jedno zdjęcie, utwórz **maksymalnie 1 sekcję**. Przy więcej niż 1 zdjęciu - **maksymalnie 3 sekcje.**
-- **Nie używaj tego samego zdjęcia więcej niż raz.**
-"""
+    cursor.close()
+    connection.close()
 
+    return eans
 
 
-        # Prepare the user message with product information, materials, and images
-        user_message = {
-            "product_id": product_id,
-            "product_name": product_name,
-            "producent_name": producent,
-            "materials": materials,
-            "sizes": sizes,
-            "images": [
-                {
-                    "img_id": image["img_id"],
-                    "description": image["description"]
-                } for image in images_with_descriptions
-            ]
-        }
-
-        # Send data to GPT
-        chat_data = {
-            "messages": [
-                {
-                    "role": "system",
-                    "content": system_prompt.strip()
-                },
-                {
-                    "role": "user",
-                    "content": json.dumps(user_message, ensure_ascii=False)
-                }
-            ]
-        }
-
-        assistant_response = send_chat_data_to_gpt(chat_data)
-        if assistant_response:
-            logger.info(f"Assistant Response:\n{assistant_response}")
+# Function to load products and their images for a chunk of EANs.
+# Returns {ean: entry} where entry has "stage", "product_info" and "images". Products the
+# journal already fetched are taken from it (with their captions and response, if any).
+def load_products_chunk(chunk, journal=None, fingerprints=None):
+    entries = {product_ean: journal.get(product_ean) for product_ean in chunk} if journal else {}
+    to_fetch = [product_ean for product_ean in chunk if not (entries.get(product_ean) or {}).get("stage")]
 
-            try:
-                # Ensure the assistant's response is valid JSON
-                response_json = json.loads(assistant_response)
-                description_parts = response_json.get('description_parts', [])
-
-                if description_parts:
-                    description_parts_to_insert(product_id, description_parts, images_with_descriptions)
-                    update_ca_tresc(product_id)
-                    logger.info(f"Product ID {product_id} updated in the database.")
-                else:
-                    logger.warning("No description parts found in the assistant's response.")
-            except json.JSONDecodeError as e:
-                logger.error(f"Error parsing assistant's response: {e}")
+    products_info = get_products_info_with_eans(to_fetch)
+    products_images = get_products_images([info["product_id"] for info in products_info.values()])
+
+    loaded = {}
+    for product_ean in chunk:
+        if product_ean not in to_fetch:
+            loaded[product_ean] = entries[product_ean]
+            continue
+
+        product_info = products_info.get(product_ean)
+        images = products_images.get(product_info["product_id"]) if product_info else None
+        entry = {"stage": None, "product_info": product_info, "images": images}
+        if journal and product_info and images:
+            journal.record(product_ean, "fetched", product_info=product_info, images=images)
+            entry["stage"] = "fetched"
+        loaded[product_ean] = entry
+
+    # Fingerprint the prompt inputs, in incremental mode unchanged products are not generated again
+    for entry in loaded.values():
+        if entry.get("product_info") and entry.get("images"):
+            entry["fingerprint"] = product_fingerprint(
+                entry["product_info"], entry["images"], prompt_version(PROMPT_MODE),
+                caption_model=CAPTION_MODEL, caption_prompt_version=CAPTION_PROMPT_VERSION, generation_model=GENERATION_MODEL
+            )
+    if fingerprints and fingerprints.incremental:
+        stored = fingerprints.get_many(
+            entry["product_info"]["product_id"] for entry in loaded.values() if entry.get("fingerprint")
+        )
+        for entry in loaded.values():
+            if entry.get("fingerprint") and stored.get(entry["product_info"]["product_id"]) == entry["fingerprint"]:
+                entry["status"] = "unchanged"
+
+    return loaded
+
+
+# Function to remember the fingerprint of a product whose description was written
+def store_fingerprint(fingerprints, product_info, fingerprint, status):
+    if fingerprints and fingerprint and status == "written":
+        fingerprints.set(product_info["product_id"], fingerprint)
+
+
+# Function to drop products the journal has already finished, their outcomes are reported as recorded
+def skip_finished_products(product_eans, journal):
+    # The same EAN listed twice would only overwrite its own description
+    product_eans = list(dict.fromkeys(product_eans))
+    if not journal:
+        return product_eans, []
+
+    remaining, finished = [], []
+    for product_ean in product_eans:
+        entry = journal.get(product_ean)
+        if entry and journal.is_done(product_ean):
+            finished.append({"ean": product_ean, "status": entry["status"], "error": entry["error"]})
+        else:
+            remaining.append(product_ean)
+
+    if finished:
+        logger.info(f"Journal: skipping {len(finished)} products finished in a previous run")
+    return remaining, finished
+
+
+# Function to run the whole pipeline for many products in one process
+def process_products_batch(product_eans, journal=None, fingerprints=None):
+    product_eans, outcomes = skip_finished_products(product_eans, journal)
+    total = len(product_eans)
+    position = 0
+
+    for chunk in chunked(product_eans, PRODUCT_CHUNK_SIZE):
+        try:
+            loaded = load_products_chunk(chunk, journal, fingerprints)
+        except Exception as e:
+            # A failed chunk query must not end the run, its products are reported as errors
+            logger.exception(f"Unexpected error while loading {len(chunk)} products")
+            for product_ean in chunk:
+                position += 1
+                outcomes.append({"ean": product_ean, "status": "error", "error": str(e)})
+                if journal:
+                    journal.finish(product_ean, "error", str(e))
+            continue
+
+        for product_ean in chunk:
+            position += 1
+            logger.info(f"[{position}/{total}] Processing EAN: {product_ean}")
+            outcomes.append(_process_batch_product(product_ean, loaded[product_ean], journal, fingerprints))
+
+    return outcomes
+
+
+def _process_batch_product(product_ean, entry, journal=None, fingerprints=None):
+    if entry.get("status") == "unchanged":
+        if journal:
+            journal.finish(product_ean, "unchanged")
+        return {"ean": product_ean, "status": "unchanged", "error": None}
+
+    try:
+        status = process_product_info(
+            product_ean, entry["product_info"], entry["images"], journal,
+            entry["stage"], entry.get("assistant_response")
+        )
+        store_fingerprint(fingerprints, entry["product_info"], entry.get("fingerprint"), status)
+        error = None
+    except DescriptionStreamError as e:
+        # Streamed response aborted early, the product is generated again on the next run
+        status = "aborted_response"
+        error = str(e)
+        if journal:
+            journal.finish(product_ean, status, error)
+    except Exception as e:
+        # One broken product must not stop the whole catalog run
+        logger.exception(f"Unexpected error for EAN {product_ean}")
+        status = "error"
+        error = str(e)
+        if journal:
+            journal.finish(product_ean, status, error)
+
+    return {"ean": product_ean, "status": status, "error": error}
+
+
+# Pipeline stage handlers. Each one gets the product item, does the blocking work
+# and either fills the item for the next stage or sets its final "status".
+# Stages already recorded in the journal are skipped.
+def _stage_caption(item, journal):
+    if item["stage"] in ("captioned", "generated"):
+        return
+    item["images"] = process_images_with_descriptions(item["images"])
+    logger.info(f"Images with descriptions: {item['images']}")
+    if journal:
+        journal.record(item["ean"], "captioned", images=item["images"])
+
+
+def _stage_generate(item, journal):
+    if item["stage"] == "generated":
+        return
+    chat_data = build_chat_data(item["product_info"], item["images"])
+    item["assistant_response"] = send_chat_data_to_gpt(chat_data, item["images"])
+    if journal:
+        journal.record(item["ean"], "generated", assistant_response=item["assistant_response"])
+
+
+def _stage_write(item, journal):
+    item["status"] = save_assistant_response(
+        item["product_info"]["product_id"], item["assistant_response"], item["images"]
+    )
+
+
+PIPELINE_STAGES = [
+    ("caption", _stage_caption),
+    ("generate", _stage_generate),
+    ("write", _stage_write),
+]
+
+# Marks the end of input for a stage worker
+_PIPELINE_DONE = object()
+
+
+def _finish_pipeline_item(item, outcomes, journal, fingerprints):
+    outcomes.append(item)
+    if journal:
+        journal.finish(item["ean"], item["status"], item["error"])
+    store_fingerprint(fingerprints, item["product_info"], item.get("fingerprint"), item["status"])
+
+
+async def _run_pipeline_stage(name, handler, in_queue, out_queue, outcomes, journal, fingerprints):
+    while True:
+        item = await in_queue.get()
+        if item is _PIPELINE_DONE:
+            return
+
+        try:
+            # The helpers are blocking (MySQL, requests), run them in a worker thread
+            await asyncio.to_thread(handler, item, journal)
+        except DescriptionStreamError as e:
+            item["status"] = "aborted_response"
+            item["error"] = str(e)
+        except Exception as e:
+            logger.exception(f"Unexpected error in stage {name} for EAN {item['ean']}")
+            item["status"] = "error"
+            item["error"] = str(e)
+
+        if item["status"] is not None or out_queue is None:
+            await asyncio.to_thread(_finish_pipeline_item, item, outcomes, journal, fingerprints)
         else:
-            logger.error("Assistant's response is empty or None.")
+            await out_queue.put(item)
+
+
+# Function to process many products with overlapping stages: while product N is generated,
+# product N+1 is captioned and N+2 is read from MySQL. Stages are connected by bounded queues.
+async def process_products_pipeline_async(product_eans, journal=None, fingerprints=None):
+    product_eans, finished = skip_finished_products(product_eans, journal)
+    outcomes = []
+    queues = [asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in PIPELINE_STAGES]
+
+    # Stages run their blocking calls with asyncio.to_thread(). The default executor has only
+    # cpu_count + 4 threads, so give every stage worker and the feeder a thread of their own.
+    # asyncio.run() shuts the executor down when the pipeline ends.
+    stage_threads = sum(max(1, workers) for workers in PIPELINE_STAGE_WORKERS.values()) + 1
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=stage_threads, thread_name_prefix="pipeline")
+    )
+
+    stage_tasks = []
+    for index, (name, handler) in enumerate(PIPELINE_STAGES):
+        out_queue = queues[index + 1] if index + 1 < len(queues) else None
+        workers = [
+            asyncio.create_task(_run_pipeline_stage(name, handler, queues[index], out_queue, outcomes, journal, fingerprints))
+            for _ in range(max(1, PIPELINE_STAGE_WORKERS[name]))
+        ]
+        stage_tasks.append(workers)
+
+    # Fetch stage: load products and their images in chunks and feed the first queue
+    position = 0
+    for chunk in chunked(product_eans, PRODUCT_CHUNK_SIZE):
+        try:
+            loaded = await asyncio.to_thread(load_products_chunk, chunk, journal, fingerprints)
+            chunk_error = None
+        except Exception as e:
+            logger.exception(f"Unexpected error while loading {len(chunk)} products")
+            loaded = {}
+            chunk_error = str(e)
+
+        for product_ean in chunk:
+            entry = loaded.get(product_ean) or {}
+            item = {
+                "position": position,
+                "ean": product_ean,
+                "status": None,
+                "error": chunk_error,
+                "stage": entry.get("stage"),
+                "product_info": entry.get("product_info"),
+                "images": entry.get("images"),
+                "assistant_response": entry.get("assistant_response"),
+                "fingerprint": entry.get("fingerprint"),
+            }
+            position += 1
+            if chunk_error:
+                item["status"] = "error"
+            elif entry.get("status") == "unchanged":
+                item["status"] = "unchanged"
+            elif not item["product_info"]:
+                logger.warning(f"No product found for Product EAN: {product_ean}")
+                item["status"] = "not_found"
+            elif not item["images"]:
+                logger.warning(f"No images found for product ID {item['product_info']['product_id']}.")
+                item["status"] = "no_images"
+
+            if item["status"] is not None:
+                await asyncio.to_thread(_finish_pipeline_item, item, outcomes, journal, fingerprints)
+            else:
+                await queues[0].put(item)
+
+    # Shut the stages down in order, so every item has left a stage before the next one is stopped
+    for index, workers in enumerate(stage_tasks):
+        for _ in workers:
+            await queues[index].put(_PIPELINE_DONE)
+        await asyncio.gather(*workers)
+
+    outcomes.sort(key=lambda item: item["position"])
+    return finished + [{"ean": item["ean"], "status": item["status"], "error": item["error"]} for item in outcomes]
+
+
+def process_products_pipeline(product_eans, journal=None, fingerprints=None):
+    return asyncio.run(process_products_pipeline_async(product_eans, journal, fingerprints))
+
+
+# Function to caption many image URLs at once. Every distinct URL is captioned only once
+# and stored in the caption cache, which the generation phase then reads from.
+def caption_images_bulk(image_urls, use_batch_api=False, batch_file="batch_caption_input.jsonl", journal=None):
+    cache = get_caption_cache()
+    distinct_urls = [url for url in dict.fromkeys(image_urls) if url]
+    missing_urls = [url for url in distinct_urls if cache.get(url, CAPTION_MODEL, CAPTION_PROMPT_VERSION) is None]
+    logger.info(f"Caption phase: {len(image_urls)} images, {len(distinct_urls)} distinct, {len(missing_urls)} not cached")
+
+    if not missing_urls:
+        return 0
+
+    captioned = 0
+    if use_batch_api:
+        batch_requests = [
+            build_batch_request(f"img-{index}", build_caption_payload(url)) for index, url in enumerate(missing_urls)
+        ]
+        results, errors = run_batch(batch_requests, batch_file, metadata={"description": "v1.4 image captions"},
+                                    journal=journal)
+        for index, url in enumerate(missing_urls):
+            body = results.get(f"img-{index}")
+            if body is None:
+                logger.error(f"Caption request for {url} failed: {errors.get(f'img-{index}')}")
+                continue
+            cache.set(url, CAPTION_MODEL, CAPTION_PROMPT_VERSION, chat_completion_content(body))
+            captioned += 1
+        if journal:
+            journal.clear_batches(batch_file)
     else:
-        logger.warning(f"No product found for Product EAN: {product_ean}")
+        # send_image_url_to_gpt stores every caption in the cache itself
+        def caption(url):
+            try:
+                send_image_url_to_gpt(url)
+                return True
+            except Exception as e:
+                logger.error(f"Error processing {url}: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=max(1, CAPTION_CONCURRENCY)) as executor:
+            captioned = sum(executor.map(caption, missing_urls))
+
+    logger.info(f"Caption phase: captioned {captioned} of {len(missing_urls)} images")
+    return captioned
+
+
+# Function to caption images of all selected products before any generation starts.
+# Images shared between products (e.g. producer banners) are captioned once.
+def run_caption_phase(product_eans, use_batch_api=False, journal=None, fingerprints=None):
+    product_eans, _ = skip_finished_products(product_eans, journal)
+    image_urls = []
+    for chunk in chunked(product_eans, PRODUCT_CHUNK_SIZE):
+        for entry in load_products_chunk(chunk, journal, fingerprints).values():
+            # Unchanged products and products with captions in the journal need no captions
+            if entry.get("images") and entry.get("status") != "unchanged" and entry["stage"] in (None, "fetched"):
+                image_urls.extend(image["url"] for image in entry["images"])
+
+    return caption_images_bulk(image_urls, use_batch_api, journal=journal)
+
+
+# Function to generate descriptions for many products with the OpenAI Batch API.
+# Products and captions are prepared first, all generation requests go in one batch
+# (cheaper and outside of per-minute limits), and results are written when it finishes.
+def process_products_batch_api(product_eans, batch_file="batch_generation_input.jsonl", journal=None, fingerprints=None):
+    all_eans = list(dict.fromkeys(product_eans))
+    product_eans, finished = skip_finished_products(all_eans, journal)
+    outcomes = {outcome["ean"]: outcome for outcome in finished}
+    prepared = {}  # custom_id -> (ean, product_info, images)
+    generated = []  # (ean, product_info, images, assistant_response) resumed from the journal
+    batch_requests = []
+    product_fingerprints = {}  # ean -> fingerprint of the prompt inputs
+
+    def finish(product_ean, status, error=None):
+        outcomes[product_ean] = {"ean": product_ean, "status": status, "error": error}
+        if journal:
+            journal.finish(product_ean, status, error)
+
+    for chunk in chunked(product_eans, PRODUCT_CHUNK_SIZE):
+        loaded = load_products_chunk(chunk, journal, fingerprints)
+
+        for product_ean in chunk:
+            entry = loaded[product_ean]
+            product_info, images = entry["product_info"], entry["images"]
+            product_fingerprints[product_ean] = entry.get("fingerprint")
+            if entry.get("status") == "unchanged":
+                finish(product_ean, "unchanged")
+                continue
+            if not product_info:
+                logger.warning(f"No product found for Product EAN: {product_ean}")
+                finish(product_ean, "not_found")
+                continue
+
+            custom_id = str(product_info["product_id"])
+            if custom_id in prepared:
+                finish(product_ean, "duplicate_product")
+                continue
+
+            if not images:
+                logger.warning(f"No images found for product ID {custom_id}.")
+                finish(product_ean, "no_images")
+                continue
+
+            if entry["stage"] == "generated":
+                generated.append((product_ean, product_info, images, entry["assistant_response"]))
+                continue
+
+            if entry["stage"] != "captioned":
+                try:
+                    images = process_images_with_descriptions(images)
+                except Exception as e:
+                    logger.exception(f"Captioning failed for EAN {product_ean}")
+                    finish(product_ean, "error", str(e))
+                    continue
+                if journal:
+                    journal.record(product_ean, "captioned", images=images)
+
+            chat_data = build_chat_data(product_info, images)
+            prepared[custom_id] = (product_ean, product_info, images)
+            batch_requests.append(build_batch_request(custom_id, build_generation_payload(chat_data)))
+
+    if batch_requests:
+        results, errors = run_batch(batch_requests, batch_file, metadata={"description": "v1.4 description generation"},
+                                    journal=journal)
+
+        for custom_id, (product_ean, product_info, images) in prepared.items():
+            if custom_id not in results:
+                logger.error(f"Batch request for product {custom_id} failed: {errors.get(custom_id)}")
+                finish(product_ean, "api_error", str(errors.get(custom_id)))
+                continue
+            try:
+                assistant_response = chat_completion_content(results[custom_id])
+            except Exception as e:
+                finish(product_ean, "api_error", str(e))
+                continue
+            if journal:
+                journal.record(product_ean, "generated", assistant_response=assistant_response)
+            generated.append((product_ean, product_info, images, assistant_response))
+        # Responses are in the journal now, a restart continues from them instead of the batch
+        if journal:
+            journal.clear_batches(batch_file)
+
+    for product_ean, product_info, images, assistant_response in generated:
+        try:
+            status = save_assistant_response(product_info["product_id"], assistant_response, images)
+            store_fingerprint(fingerprints, product_info, product_fingerprints.get(product_ean), status)
+            finish(product_ean, status)
+        except Exception as e:
+            logger.exception(f"Unexpected error for EAN {product_ean}")
+            finish(product_ean, "error", str(e))
+
+    return [outcomes[product_ean] for product_ean in all_eans]
+
+
+# Function to check an assistant response without writing it, with the same rules as the write path
+def evaluate_assistant_response(assistant_response, images):
+    evaluation = {"valid_json": False, "valid": False, "parts": 0, "error": None, "text_length": 0}
+    try:
+        response_json = json.loads(assistant_response)
+    except (json.JSONDecodeError, TypeError) as e:
+        evaluation["error"] = str(e)
+        return evaluation
+
+    evaluation["valid_json"] = True
+    try:
+        description_parts = validate_description(response_json, images)
+    except DescriptionValidationError as e:
+        evaluation["error"] = str(e)
+        return evaluation
+
+    evaluation.update({
+        "valid": True,
+        "parts": len(description_parts),
+        "text_length": sum(len(part["capd_desc_text"]) + len(part["capd_desc_text2"]) for part in description_parts)
+    })
+    return evaluation
+
+
+# Function to A/B compare the prompt modes on the same products, nothing is written to the shop.
+# Every product is generated once per mode, responses and metrics go to report_file.
+def compare_prompt_modes(product_eans, report_file="prompt_comparison.jsonl"):
+    client = get_openai_client()
+    totals = {mode: {"products": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "seconds": 0.0, "valid": 0}
+              for mode in PROMPT_MODES}
+
+    with open(report_file, "w", encoding="utf-8") as report:
+        for chunk in chunked(product_eans, PRODUCT_CHUNK_SIZE):
+            for product_ean, entry in load_products_chunk(chunk).items():
+                if not entry["product_info"] or not entry["images"]:
+                    logger.warning(f"Skipping EAN {product_ean} in prompt comparison: no product or images")
+                    continue
+                try:
+                    images = process_images_with_descriptions(entry["images"])
+                except OpenAIAPIError as e:
+                    logger.error(f"Prompt comparison of EAN {product_ean} skipped, captioning failed: {e}")
+                    continue
+
+                for mode in PROMPT_MODES:
+                    payload = build_generation_payload(build_chat_data(entry["product_info"], images, prompt_mode=mode), mode)
+                    started = time.monotonic()
+                    try:
+                        response_json = client.chat_completion(payload, timeout=GENERATION_TIMEOUT)
+                    except OpenAIAPIError as e:
+                        logger.error(f"Prompt comparison of EAN {product_ean} in {mode} mode failed: {e}")
+                        continue
+                    seconds = time.monotonic() - started
+                    assistant_response = response_json["choices"][0]["message"]["content"]
+                    usage = response_json.get("usage") or {}
+                    evaluation = evaluate_assistant_response(assistant_response, images)
+
+                    mode_totals = totals[mode]
+                    mode_totals["products"] += 1
+                    mode_totals["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                    mode_totals["completion_tokens"] += usage.get("completion_tokens", 0)
+                    mode_totals["cached_tokens"] += (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+                    mode_totals["seconds"] += seconds
+                    mode_totals["valid"] += evaluation["valid"]
+
+                    report.write(json.dumps({
+                        "ean": product_ean,
+                        "mode": mode,
+                        "prompt_version": prompt_version(mode),
+                        "prompt_tokens": usage.get("prompt_tokens"),
+                        "completion_tokens": usage.get("completion_tokens"),
+                        "seconds": round(seconds, 2),
+                        **evaluation,
+                        "assistant_response": assistant_response
+                    }, ensure_ascii=False) + "\n")
+
+    for mode, mode_totals in totals.items():
+        products = mode_totals["products"] or 1
+        logger.info(f"Prompt mode {mode}: {mode_totals['products']} products, "
+                    f"avg {mode_totals['prompt_tokens'] / products:.0f} prompt ({mode_totals['cached_tokens'] / products:.0f} cached) / "
+                    f"{mode_totals['completion_tokens'] / products:.0f} completion tokens, "
+                    f"avg {mode_totals['seconds'] / products:.1f}s, {mode_totals['valid']} valid")
+    logger.info(f"Prompt comparison written to {report_file}")
+    return totals
+
+
+# Function to log a summary of the batch run and optionally save per-product outcomes
+def report_batch_outcomes(outcomes, report_file=None):
+    counts = {}
+    for outcome in outcomes:
+        counts[outcome["status"]] = counts.get(outcome["status"], 0) + 1
+
+    logger.info(f"Batch finished: {len(outcomes)} products, outcomes: {counts}")
+
+    if report_file:
+        with open(report_file, "w", encoding="utf-8") as file:
+            for outcome in outcomes:
+                file.write(json.dumps(outcome, ensure_ascii=False) + "\n")
+        logger.info(f"Per-product outcomes written to {report_file}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate product descriptions for one or many EANs.")
+    parser.add_argument("--ean", action="append", default=[], help="Product EAN (can be repeated)")
+    parser.add_argument("--ean-file", help="File with one EAN per line, '-' reads from stdin")
+    parser.add_argument("--all-active", action="store_true", help="Process every active product (CA_AKTYWNY = 'T')")
+    parser.add_argument("--sql-filter", help="Extra SQL condition on cms_art_produkty for active products, e.g. \"CA_PRODUCENT_ID = 12\"")
+    parser.add_argument("--report", help="Write per-product outcomes as JSONL to this file")
+    parser.add_argument("--pipeline", action="store_true", help="Overlap DB reads, captioning, generation and writes across products")
+    parser.add_argument("--batch-api", action="store_true", help="Generate all descriptions with one OpenAI Batch API job (results within 24h)")
+    parser.add_argument("--batch-file", default="batch_generation_input.jsonl", help="Batch API input file written in --batch-api mode")
+    parser.add_argument("--journal", help="Checkpoint journal (SQLite file), rerunning with the same file resumes the run")
+    parser.add_argument("--incremental", action="store_true", help="Skip products whose prompt inputs did not change since their last written description")
+    parser.add_argument("--fingerprints", default="description_fingerprints.sqlite3", help="File with fingerprints of written products")
+    parser.add_argument("--prompt-mode", choices=PROMPT_MODES, default=PROMPT_MODE, help="Generation prompt format (default PROMPT_MODE or full)")
+    parser.add_argument("--compare-prompts", metavar="REPORT", help="Generate every product in all prompt modes without writing, save responses and metrics to REPORT")
+    parser.add_argument("--stream", action="store_true", help="Stream generation responses and abort broken ones early (also STREAM_GENERATION=1)")
+    parser.add_argument("--caption-phase", action="store_true", help="Caption all distinct images of the selected products first (with --batch-api as one Batch API job)")
+    return parser.parse_args(argv)
+
+
+# Main function to process products and send them to the GPT-4 API using EAN
+def main(argv=None):
+    global PROMPT_MODE, STREAM_GENERATION
+    args = parse_args(argv)
+    PROMPT_MODE = args.prompt_mode
+    STREAM_GENERATION = STREAM_GENERATION or args.stream
+
+    product_eans = list(args.ean)
+    if args.ean_file:
+        product_eans.extend(read_eans_from_file(args.ean_file))
+    if args.all_active or args.sql_filter:
+        product_eans.extend(get_active_product_eans(args.sql_filter))
+
+    if not product_eans:
+        if args.ean or args.ean_file or args.all_active or args.sql_filter:
+            # A selection that matched nothing must not fall back to the example product
+            logger.warning("No products selected, nothing to do")
+            return
+        product_eans = ['5903351255462']  # Example product EAN
 
+    if args.compare_prompts:
+        compare_prompt_modes(product_eans, args.compare_prompts)
+        return
 
-# Main function to process and send one product to the GPT-4 API using EAN
-def main():
-    product_ean = '5903351255462'  # Example product EAN
-    display_fine_tune_input_for_single_product(product_ean)
+    journal = RunJournal(args.journal) if args.journal else None
+    # Fingerprints are stored on every run, so a later incremental run knows what is up to date
+    fingerprints = FingerprintStore(args.fingerprints, incremental=args.incremental)
+
+    if args.caption_phase:
+        run_caption_phase(product_eans, use_batch_api=args.batch_api, journal=journal, fingerprints=fingerprints)
+
+    if args.batch_api:
+        # The batch is projected by run_batch() when it is submitted
+        outcomes = process_products_batch_api(product_eans, args.batch_file, journal, fingerprints)
+    elif args.pipeline:
+        log_run_projection(len(product_eans))
+        outcomes = process_products_pipeline(product_eans, journal, fingerprints)
+    else:
+        log_run_projection(len(product_eans))
+        outcomes = process_products_batch(product_eans, journal, fingerprints)
+    report_batch_outcomes(outcomes, args.report)
+    fingerprints.close()
+
+    # Direct API calls of this run (Batch API jobs are projected when they are submitted)
+    for line in get_openai_client().usage_summary():
+        logger.info(f"API usage {line}")
+
+    if journal:
+        logger.info(f"Journal {args.journal}: {journal.summary()}")
+        journal.close()
 
 if __name__ == "__main__":
     main()